@@ -8,11 +8,13 @@ multiple SIP accounts and their properties.
 
 from __future__ import absolute_import, with_statement
 
+import heapq
 import random
 import re
 import string
 
-from itertools import chain
+from collections import deque
+from itertools import chain, count
 from time import time
 from weakref import WeakKeyDictionary
 
@@ -27,16 +29,16 @@ from twisted.internet import reactor
 from zope.interface import implements
 
 from sipsimple import bonjour
-from sipsimple.core import ContactHeader, Credentials, Engine, FromHeader, FrozenSIPURI, Registration, RouteHeader, SIPURI, Subscription, ToHeader, PJSIPError, SIPCoreError
+from sipsimple.core import ContactHeader, Credentials, Engine, FromHeader, FrozenSIPURI, Registration, Request, RouteHeader, SIPURI, Subscription, ToHeader, PJSIPError, SIPCoreError
 from sipsimple.configuration import ConfigurationManager, Setting, SettingsGroup, SettingsObject, SettingsObjectID
 from sipsimple.configuration.datatypes import AudioCodecList, MSRPConnectionModel, MSRPRelayAddress, MSRPTransport, NonNegativeInteger, Path, SIPAddress, SIPProxyAddress, SRTPEncryption, STUNServerAddressList, XCAPRoot
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.lookup import DNSLookup, DNSLookupError, RouteHealthCache
 from sipsimple.payloads.messagesummary import MessageSummary, ValidationError
 from sipsimple.util import Command, TimestampedNotificationData, call_in_green_thread, call_in_twisted_thread, classproperty, limit, run_in_green_thread, run_in_twisted_thread, user_info
 
 
-__all__ = ['Account', 'BonjourAccount', 'AccountManager', 'AccountExists']
+__all__ = ['Account', 'BonjourAccount', 'AccountManager', 'AccountExists', 'RegistrationScheduler']
 
 
 class ContactURI(SIPAddress):
@@ -75,6 +77,166 @@ class RestartSelect(Exception): pass
 class AccountExists(ValueError): pass
 
 
+class ScheduledRefresh(object):
+    """
+    A call scheduled through the RegistrationScheduler. It provides the same
+    active/cancel interface as the calls scheduled using reactor.callLater.
+    """
+
+    def __init__(self, scheduler, time, func, args, kwargs):
+        self.scheduler = scheduler
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.called = False
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.scheduler.pending_refreshes -= 1
+
+
+class RegistrationScheduler(object):
+    """
+    This is a singleton object which controls when the accounts are allowed
+    to start a registration. It limits the number of registrations which are
+    in progress at the same time and the rate at which new ones are started
+    (per second), according to the sip.register_concurrency and
+    sip.register_rate_limit settings. A value of 0 for either of them means
+    no limit. This avoids flooding the DNS servers and the registrars when a
+    large number of accounts are activated at the same time.
+
+    It also keeps the refreshes of all the registrations ordered by time and
+    uses a single timer to run them in batches, with the ones which are due
+    in less than refresh_ahead seconds being run together with the current
+    batch.
+    """
+
+    __metaclass__ = Singleton
+
+    batch_size = 100
+    refresh_ahead = 1.0
+
+    def __init__(self):
+        self.in_flight = 0
+        self.dispatched = 0
+        self.pending_refreshes = 0
+        self._waiters = deque()
+        self._tokens = 1.0
+        self._last_update = time()
+        self._timer = None
+        self._refreshes = []
+        self._refresh_sequence = count()
+        self._refresh_timer = None
+        self._refresh_timer_time = None
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    @property
+    def statistics(self):
+        return dict(queue_depth=self.queue_depth, in_flight=self.in_flight, dispatched=self.dispatched, pending_refreshes=self.pending_refreshes)
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """
+        Schedule func to be called after delay seconds. Returns a
+        ScheduledRefresh object which can be used to cancel the call.
+        """
+        refresh = ScheduledRefresh(self, time()+delay, func, args, kwargs)
+        heapq.heappush(self._refreshes, (refresh.time, self._refresh_sequence.next(), refresh))
+        self.pending_refreshes += 1
+        self._update_refresh_timer()
+        return refresh
+
+    def acquire(self):
+        """
+        Wait until a new registration is allowed to start. This method must be
+        called from a green thread and every successful call must be matched by
+        a call to release once the registration attempt is over.
+        """
+        event = coros.event()
+        self._waiters.append(event)
+        self._process_waiters()
+        try:
+            event.wait()
+        except:
+            # we were killed while waiting, give back our slot if we got one
+            if event in self._waiters:
+                self._waiters.remove(event)
+            else:
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._process_waiters()
+
+    def get_refresh_delay(self, expires):
+        """
+        Return a randomly chosen delay after which a registration which
+        expires in the specified number of seconds should be refreshed, so
+        that the refreshes of accounts which registered at the same time are
+        spread over the registration interval.
+        """
+        return random.uniform(expires/2.0, limit(expires-Request.expire_warning_time, min=expires/2.0))
+
+    def _process_waiters(self):
+        settings = SIPSimpleSettings()
+        concurrency = settings.sip.register_concurrency
+        rate = settings.sip.register_rate_limit
+        now = time()
+        if rate:
+            self._tokens = limit(self._tokens + (now-self._last_update)*rate, max=rate)
+        self._last_update = now
+        while self._waiters and (not concurrency or self.in_flight < concurrency):
+            if rate:
+                if self._tokens < 1:
+                    if self._timer is None or not self._timer.active():
+                        self._timer = reactor.callLater((1-self._tokens)/rate, self._process_waiters)
+                    break
+                self._tokens -= 1
+            self.in_flight += 1
+            self.dispatched += 1
+            self._waiters.popleft().send()
+
+    def _update_refresh_timer(self):
+        # Cancelled refreshes are only discarded once they reach the top of the heap
+        while self._refreshes and not self._refreshes[0][2].active():
+            heapq.heappop(self._refreshes)
+        if not self._refreshes:
+            if self._refresh_timer is not None and self._refresh_timer.active():
+                self._refresh_timer.cancel()
+            self._refresh_timer = None
+            return
+        next_time = self._refreshes[0][0]
+        if self._refresh_timer is not None and self._refresh_timer.active():
+            if self._refresh_timer_time <= next_time:
+                return
+            self._refresh_timer.cancel()
+        self._refresh_timer = reactor.callLater(limit(next_time-time(), min=0), self._process_refreshes)
+        self._refresh_timer_time = next_time
+
+    def _process_refreshes(self):
+        self._refresh_timer = None
+        batch_limit = time() + self.refresh_ahead
+        batch = []
+        while self._refreshes and len(batch) < self.batch_size and self._refreshes[0][0] <= batch_limit:
+            refresh = heapq.heappop(self._refreshes)[2]
+            if refresh.active():
+                refresh.called = True
+                self.pending_refreshes -= 1
+                batch.append(refresh)
+        for refresh in batch:
+            refresh.func(*refresh.args, **refresh.kwargs)
+        self._update_refresh_timer()
+
+
 class AccountRegistrar(object):
     implements(IObserver)
 
@@ -88,6 +250,7 @@ class AccountRegistrar(object):
         self._data_channel = coros.queue()
         self._current_command = None
         self._dns_wait = 1
+        self._last_route = None
         self._refresh_timer = None
         self._register_wait = 1
         self._registration = None
@@ -135,7 +298,6 @@ class AccountRegistrar(object):
 
     def _CH_register(self, command):
         notification_center = NotificationCenter()
-        settings = SIPSimpleSettings()
 
         # Cancel any timer which would refresh the registration
         if self._refresh_timer is not None and self._refresh_timer.active():
@@ -152,27 +314,22 @@ class AccountRegistrar(object):
         else:
             notification_center.post_notification('SIPAccountRegistrationWillRefresh', sender=self.account, data=TimestampedNotificationData())
 
+        # Wait for our turn, so that we don't flood the network when many accounts register at the same time
+        scheduler = RegistrationScheduler()
+        scheduler.acquire()
+
         try:
-            # Lookup routes
             if self.account.sip.outbound_proxy is not None:
                 uri = SIPURI(host=self.account.sip.outbound_proxy.host,
                              port=self.account.sip.outbound_proxy.port,
                              parameters={'transport': self.account.sip.outbound_proxy.transport})
             else:
                 uri = SIPURI(host=self.account.id.domain)
-            lookup = DNSLookup()
-            try:
-                routes = lookup.lookup_sip_proxy(uri, settings.sip.transport_list).wait()
-            except DNSLookupError, e:
-                timeout = random.uniform(self._dns_wait, 2*self._dns_wait)
-                self._dns_wait = limit(2*self._dns_wait, max=30)
-                raise SIPAccountRegistrationError(error='DNS lookup failed: %s' % e, timeout=timeout)
-            else:
-                self._dns_wait = 1
+            route_cache = RouteHealthCache()
 
             # Register by trying each route in turn
             register_timeout = time() + 30
-            for route in routes:
+            for route in self._iter_routes(uri):
                 remaining_time = register_timeout-time()
                 if remaining_time > 0:
                     # Rebuild contact according to route
@@ -197,6 +354,8 @@ class AccountRegistrar(object):
                             raise SIPAccountRegistrationError(error='Authentication failed', timeout=timeout)
                         else:
                             # Otherwise just try the next route
+                            if route_cache.is_route_failure(e.code):
+                                route_cache.failure(uri.host, route)
                             continue
                     else:
                         notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account,
@@ -211,6 +370,10 @@ class AccountRegistrar(object):
                                                                                                expires=notification.data.expires_in,
                                                                                                registrar=route))
                         self._register_wait = 1
+                        self._last_route = route
+                        route_cache.success(uri.host, route)
+                        # Refresh at a random point within the interval, rather than all accounts at the same time
+                        self._refresh_timer = scheduler.call_later(scheduler.get_refresh_delay(notification.data.expires_in or self.account.sip.register_interval), self._command_channel.send, Command('register'))
                         command.signal()
                         break
             else:
@@ -222,10 +385,36 @@ class AccountRegistrar(object):
             self.registered = False
             notification_center.post_notification('SIPAccountRegistrationDidFail', sender=self.account,
                                                   data=TimestampedNotificationData(error=e.error, timeout=e.timeout))
-            self._refresh_timer = reactor.callLater(e.timeout, self._command_channel.send, Command('register', command.event))
+            self._refresh_timer = scheduler.call_later(e.timeout, self._command_channel.send, Command('register', command.event))
             # Since we weren't able to register, recreate a registration next time
             notification_center.remove_observer(self, sender=self._registration)
             self._registration = None
+        finally:
+            scheduler.release()
+
+    def _iter_routes(self, uri):
+        settings = SIPSimpleSettings()
+
+        # Reuse the route of the last successful registration while its DNS records are still valid
+        last_route = self._last_route
+        if last_route is not None and last_route.expiration > time():
+            yield last_route
+        self._last_route = None
+
+        # Lookup routes
+        lookup = DNSLookup()
+        try:
+            routes = lookup.lookup_sip_proxy(uri, settings.sip.transport_list).wait()
+        except DNSLookupError, e:
+            timeout = random.uniform(self._dns_wait, 2*self._dns_wait)
+            self._dns_wait = limit(2*self._dns_wait, max=30)
+            raise SIPAccountRegistrationError(error='DNS lookup failed: %s' % e, timeout=timeout)
+        else:
+            self._dns_wait = 1
+        for route in RouteHealthCache().sort_routes(uri.host, routes):
+            # Don't try again the route we reused if it just failed
+            if last_route is None or (route.address, route.port, route.transport) != (last_route.address, last_route.port, last_route.transport):
+                yield route
 
     def _CH_unregister(self, command):
         notification_center = NotificationCenter()
@@ -257,6 +446,7 @@ class AccountRegistrar(object):
 
     def _CH_reload_settings(self, command):
         notification_center = NotificationCenter()
+        self._last_route = None
         if self._registration is not None:
             notification_center.remove_observer(self, sender=self._registration)
             self._registration = None
@@ -274,7 +464,9 @@ class AccountRegistrar(object):
         self._data_channel.send_exception(SIPRegistrationDidFail(notification.data))
 
     def _NH_SIPRegistrationWillExpire(self, notification):
-        self._command_channel.send(Command('register'))
+        # The refresh is normally scheduled earlier by us, only act if that didn't happen
+        if self._refresh_timer is None:
+            self._command_channel.send(Command('register'))
 
     def _NH_SIPRegistrationDidEnd(self, notification):
         self._data_channel.send(notification)
@@ -283,10 +475,12 @@ class AccountRegistrar(object):
         self._data_channel.send_exception(SIPRegistrationDidNotEnd(notification.data))
 
     def _NH_SystemIPAddressDidChange(self, notification):
+        self._last_route = None
         if self._registration is not None:
             self._command_channel.send(Command('register'))
 
     def _NH_SystemDidWakeUpFromSleep(self, notification):
+        self._last_route = None
         if self._registration is not None:
             self._command_channel.send(Command('register'))
 
@@ -377,6 +571,10 @@ class AccountMWISubscriptionHandler(object):
                 timeout = random.uniform(15, 30)
                 raise SubscriptionError(error='DNS lookup failed: %s' % e, timeout=timeout)
 
+            # Start with the routes which worked last
+            route_cache = RouteHealthCache()
+            routes = route_cache.sort_routes(uri.host, routes)
+
             timeout = time() + 30
             for route in routes:
                 remaining_time = timeout - time()
@@ -422,8 +620,11 @@ class AccountMWISubscriptionHandler(object):
                             raise SubscriptionError(error='Method or event not supported', timeout=timeout)
                         else:
                             # Otherwise just try the next route
+                            if route_cache.is_route_failure(e.code):
+                                route_cache.failure(uri.host, route)
                             continue
                     else:
+                        route_cache.success(uri.host, route)
                         try:
                             with api.timeout(5):
                                 while True:
@@ -940,6 +1141,7 @@ class RTPSettings(SettingsGroup):
     audio_codec_list = Setting(type=AudioCodecList, default=None, nillable=True)
     srtp_encryption = Setting(type=SRTPEncryption, default='disabled')
     use_srtp_without_tls = Setting(type=bool, default=False)
+    transport_pool_size = Setting(type=NonNegativeInteger, default=0)
 
 
 class DialogEventSettings(SettingsGroup):
@@ -977,6 +1179,7 @@ class TLSSettings(SettingsGroup):
 class MSRPSettings(SettingsGroup):
     transport = Setting(type=MSRPTransport, default='tls')
     connection_model = Setting(type=MSRPConnectionModel, default='relay')
+    relay_pool_size = Setting(type=NonNegativeInteger, default=0)
 
 
 class AccountID(SettingsObjectID):
@@ -1384,6 +1587,65 @@ class BonjourAccount(SettingsObject):
     __str__ = __repr__
 
 
+class AccountShutdownCoordinator(object):
+    """
+    Stops a number of accounts, at most concurrency of them at the same time
+    (0 meaning no limit). Once the timeout expires, the workers keep stopping
+    the remaining accounts with the same concurrency for at most grace_period
+    more seconds. The accounts which were not stopped by then are reported as
+    pending and their unregistrations are not sent. A timeout of 0 means
+    waiting for all the accounts to stop.
+    """
+
+    implements(IObserver)
+
+    grace_period = 2
+
+    def __init__(self, accounts, concurrency=0, timeout=10):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.stopped_accounts = 0
+        self.pending_accounts = 0
+        self.unregistered_accounts = set()
+        self._accounts = deque(accounts)
+
+    @property
+    def confirmed_unregistrations(self):
+        return len(self.unregistered_accounts)
+
+    def run(self):
+        """
+        Stop the accounts and return once they all stopped or the timeout and
+        the grace period expired. This method must be called from a green
+        thread.
+        """
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SIPAccountRegistrationDidEnd')
+        try:
+            workers = [proc.spawn(self._worker) for i in xrange(self.concurrency or len(self._accounts))]
+            if not self.timeout:
+                proc.waitall(workers)
+                return
+            try:
+                with api.timeout(self.timeout + self.grace_period):
+                    proc.waitall(workers)
+            except api.TimeoutError:
+                # Give up on the accounts which the workers did not get to
+                self.pending_accounts = len(self._accounts) + len([worker for worker in workers if not worker.dead])
+                self._accounts.clear()
+        finally:
+            notification_center.remove_observer(self, name='SIPAccountRegistrationDidEnd')
+
+    def _worker(self):
+        while self._accounts:
+            account = self._accounts.popleft()
+            account.stop()
+            self.stopped_accounts += 1
+
+    def handle_notification(self, notification):
+        self.unregistered_accounts.add(notification.sender)
+
+
 class AccountManager(object):
     """
     This is a singleton object which manages all the SIP accounts. When its
@@ -1442,14 +1704,21 @@ class AccountManager(object):
     def stop(self):
         """
         Stop the accounts, which will determine the ones that were enabled to
-        deactivate. This method returns only once the accounts were stopped
-        successfully or they timed out trying.
+        deactivate. At most sip.shutdown_concurrency accounts are stopped at
+        the same time. This method returns once the accounts were stopped or
+        sip.shutdown_timeout seconds and a short grace period passed, in which
+        case the accounts which were not stopped yet are reported as pending
+        and are not unregistered. A value of 0 for either setting means no
+        limit.
         """
         notification_center = NotificationCenter()
+        settings = SIPSimpleSettings()
         notification_center.post_notification('SIPAccountManagerWillEnd', sender=self, data=TimestampedNotificationData())
-        procs = [proc.spawn(account.stop) for account in self.accounts.itervalues()]
-        proc.waitall(procs)
-        notification_center.post_notification('SIPAccountManagerDidEnd', sender=self, data=TimestampedNotificationData())
+        coordinator = AccountShutdownCoordinator(self.accounts.values(), concurrency=settings.sip.shutdown_concurrency, timeout=settings.sip.shutdown_timeout)
+        coordinator.run()
+        notification_center.post_notification('SIPAccountManagerDidEnd', sender=self, data=TimestampedNotificationData(stopped_accounts=coordinator.stopped_accounts,
+                                                                                                                     pending_accounts=coordinator.pending_accounts,
+                                                                                                                     confirmed_unregistrations=coordinator.confirmed_unregistrations))
 
     def has_account(self, id):
         return id in self.accounts
@@ -19,10 +19,10 @@ from xcaplib import client as xcap_client
 from zope.interface import implements
 
 from sipsimple.account import Account, AccountManager
-from sipsimple.audio import AudioDevice, RootAudioBridge
+from sipsimple.audio import AudioDevice, LeastLoadedMixerPolicy, RootAudioBridge
 from sipsimple.configuration import ConfigurationManager
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.core import AudioMixer, Engine, SIPCoreError, SIPURI
+from sipsimple.core import AudioMixer, Engine, SIPCoreError, SIPURI, get_object_counts
 from sipsimple.lookup import DNSLookup, DNSLookupError
 from sipsimple.session import SessionManager
 from sipsimple.util import run_in_twisted_thread, run_in_green_thread, classproperty, Command, TimestampedNotificationData
@@ -50,6 +50,9 @@ class SIPApplication(object):
     alert_audio_bridge = ApplicationAttribute(value=None)
     voice_audio_device = ApplicationAttribute(value=None)
     voice_audio_bridge = ApplicationAttribute(value=None)
+    headless_audio_mixers = ApplicationAttribute(value=[])
+    audio_mixer_policy = ApplicationAttribute(value=None)
+    retired_audio_mixer_policies = ApplicationAttribute(value=[])
 
     _channel = ApplicationAttribute(value=coros.queue())
     _nat_detect_channel = ApplicationAttribute(value=coros.queue())
@@ -183,6 +186,7 @@ class SIPApplication(object):
         self.alert_audio_device = AudioDevice(alert_mixer)
         self.alert_audio_bridge = RootAudioBridge(alert_mixer)
         self.alert_audio_bridge.add(self.alert_audio_device)
+        self._initialize_headless_mixers()
 
         settings.audio.input_device = voice_mixer.input_device
         settings.audio.output_device = voice_mixer.output_device
@@ -251,6 +255,52 @@ class SIPApplication(object):
     def voice_audio_mixer(cls):
         return cls.voice_audio_bridge.mixer if cls.voice_audio_bridge else None
 
+    @classmethod
+    def get_audio_mixer(cls, stream, mixer=None):
+        """
+        Return the mixer on which the specified audio stream should be placed.
+        If mixer is given, such as the mixer of a conference, the stream is
+        placed on it. Otherwise the streams are placed on the headless mixers
+        according to audio_mixer_policy if there are any, or on the voice
+        mixer.
+        """
+        if cls.audio_mixer_policy is not None:
+            return cls.audio_mixer_policy.get_mixer(stream, mixer)
+        return mixer or cls.voice_audio_mixer
+
+    @classmethod
+    def get_headless_audio_mixers(cls):
+        """
+        Return the headless mixers, including the ones which were replaced
+        after the audio settings changed but still have streams on them.
+        """
+        cls.retired_audio_mixer_policies[:] = [policy for policy in cls.retired_audio_mixer_policies if policy.in_use]
+        return list(cls.headless_audio_mixers) + [mixer for policy in cls.retired_audio_mixer_policies for mixer in policy.mixers]
+
+    @classmethod
+    def get_object_counts(cls):
+        """
+        Return a dictionary with the number of media objects which are alive:
+        the AudioStream objects in use and the RTPTransport, AudioTransport and
+        MixerPort objects, along with the number of used slots of all the
+        audio mixers (used_slots). The numbers should go back to their initial
+        values when all the sessions have ended, otherwise something leaks.
+        """
+        from sipsimple.streams.rtp import AudioStream
+        counts = get_object_counts()
+        counts['AudioStream'] = len(AudioStream._streams)
+        mixers = [cls.voice_audio_mixer, cls.alert_audio_mixer] + cls.get_headless_audio_mixers()
+        counts['used_slots'] = sum(mixer.used_slot_count for mixer in mixers if mixer is not None)
+        return counts
+
+    def _initialize_headless_mixers(self):
+        settings = SIPSimpleSettings()
+        # the new mixers are only used for the new streams, the old ones are kept until their streams are released
+        if isinstance(self.audio_mixer_policy, LeastLoadedMixerPolicy) and self.audio_mixer_policy.in_use:
+            self.retired_audio_mixer_policies.append(self.audio_mixer_policy)
+        self.headless_audio_mixers = [AudioMixer(None, None, settings.audio.sample_rate, 0) for i in xrange(settings.audio.headless_mixer_count)]
+        self.audio_mixer_policy = LeastLoadedMixerPolicy(self.headless_audio_mixers) if self.headless_audio_mixers else None
+
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
@@ -272,6 +322,8 @@ class SIPApplication(object):
         account_manager = AccountManager()
 
         if notification.sender is settings:
+            if 'audio.sample_rate' in notification.data.modified or 'audio.headless_mixer_count' in notification.data.modified:
+                self._initialize_headless_mixers()
             if 'audio.sample_rate' in notification.data.modified:
                 alert_device = settings.audio.alert_device
                 if alert_device not in (None, 'system_default') and alert_device not in engine.output_devices:
@@ -7,18 +7,23 @@ Audio support.
 
 from __future__ import absolute_import, with_statement
 
-__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'RootAudioBridge', 'WavePlayer', 'WaveRecorder']
+__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'RootAudioBridge', 'ActiveSpeakerAudioBridge', 'LeastLoadedMixerPolicy', 'WaveCache', 'WavePlayer', 'WaveRecorder', 'BufferedWaveRecorder']
 
+import audioop
 import os
+import struct
+import wave
 import weakref
 from functools import partial
-from threading import RLock
+from itertools import count
+from threading import Event, RLock, Thread
 
 from application.notification import IObserver, NotificationCenter, ObserverWeakrefProxy
+from application.python.util import Singleton
 from eventlet import coros
 from zope.interface import Attribute, Interface, implements
 
-from sipsimple.core import MixerPort, RecordingWaveFile, SIPCoreError, WaveFile
+from sipsimple.core import MemoryWaveFile, MixerPort, RecordingBuffer, RecordingWaveFile, SIPCoreError, WaveFile
 from sipsimple.util import Command, TimestampedNotificationData, combinations, makedirs, run_in_green_thread, run_in_twisted_thread
 
 
@@ -113,24 +118,27 @@ class AudioBridge(object):
     contain another bridge. This must be done such that the resulting structure
     is a tree (i.e. no loops are allowed). All leafs of the tree will be
     connected as if they were the children of a single bridge.
+
+    The MixerPorts which aggregate the audio of the bridge are only created
+    when the first port is added to it, so an empty bridge has no slots.
     """
 
     implements(IAudioPort, IObserver)
 
     def __init__(self, mixer):
         self.mixer = mixer
-        self.multiplexer = MixerPort(mixer)
-        self.multiplexer.start()
-        self.demultiplexer = MixerPort(mixer)
-        self.demultiplexer.start()
+        self.multiplexer = None
+        self.demultiplexer = None
         self.ports = set()
         self._lock = RLock()
+        self._stopped = False
         notification_center = NotificationCenter()
         notification_center.add_observer(ObserverWeakrefProxy(self), name='AudioPortDidChangeSlots')
 
     def __del__(self):
-        self.multiplexer.stop()
-        self.demultiplexer.stop()
+        if self.multiplexer is not None:
+            self.multiplexer.stop()
+            self.demultiplexer.stop()
         for port1, port2 in ((wr1(), wr2()) for wr1, wr2 in combinations(self.ports, 2)):
             if port1 is None or port2 is None:
                 continue
@@ -145,11 +153,11 @@ class AudioBridge(object):
 
     @property
     def consumer_slot(self):
-        return self.demultiplexer.slot if self.demultiplexer.is_active else None
+        return self.demultiplexer.slot if self.demultiplexer is not None and self.demultiplexer.is_active else None
 
     @property
     def producer_slot(self):
-        return self.multiplexer.slot if self.multiplexer.is_active else None
+        return self.multiplexer.slot if self.multiplexer is not None and self.multiplexer.is_active else None
 
     def add(self, port):
         with self._lock:
@@ -159,9 +167,10 @@ class AudioBridge(object):
                 raise ValueError("expected port with Mixer %r, got %r" % (self.mixer, port.mixer))
             if weakref.ref(port) in self.ports:
                 return
-            if port.consumer_slot is not None and self.demultiplexer.slot:
+            self._create_multiplexers()
+            if port.consumer_slot is not None and self.demultiplexer is not None and self.demultiplexer.slot:
                 self.mixer.connect_slots(self.demultiplexer.slot, port.consumer_slot)
-            if port.producer_slot is not None and self.multiplexer.slot:
+            if port.producer_slot is not None and self.multiplexer is not None and self.multiplexer.slot:
                 self.mixer.connect_slots(port.producer_slot, self.multiplexer.slot)
             for other in (wr() for wr in self.ports):
                 if other is None:
@@ -181,9 +190,9 @@ class AudioBridge(object):
         with self._lock:
             if weakref.ref(port) not in self.ports:
                 raise ValueError("port %r is not part of this bridge" % port)
-            if port.consumer_slot is not None and self.demultiplexer.slot:
+            if port.consumer_slot is not None and self.demultiplexer is not None and self.demultiplexer.slot:
                 self.mixer.disconnect_slots(self.demultiplexer.slot, port.consumer_slot)
-            if port.producer_slot is not None and self.multiplexer.slot:
+            if port.producer_slot is not None and self.multiplexer is not None and self.multiplexer.slot:
                 self.mixer.disconnect_slots(port.producer_slot, self.multiplexer.slot)
             for other in (wr() for wr in self.ports):
                 if other is None:
@@ -207,17 +216,19 @@ class AudioBridge(object):
                     if port2.producer_slot is not None and port1.consumer_slot is not None:
                         self.mixer.disconnect_slots(port2.producer_slot, port1.consumer_slot)
             self.ports.clear()
-            self.multiplexer.stop()
-            self.demultiplexer.stop()
+            self._stopped = True
+            if self.multiplexer is not None:
+                self.multiplexer.stop()
+                self.demultiplexer.stop()
 
     def handle_notification(self, notification):
         with self._lock:
             if weakref.ref(notification.sender) not in self.ports:
                 return
             if notification.data.consumer_slot_changed:
-                if notification.data.old_consumer_slot is not None:
+                if notification.data.old_consumer_slot is not None and self.demultiplexer is not None:
                     self.mixer.disconnect_slots(self.demultiplexer.slot, notification.data.old_consumer_slot)
-                if notification.data.new_consumer_slot is not None:
+                if notification.data.new_consumer_slot is not None and self.demultiplexer is not None:
                     self.mixer.connect_slots(self.demultiplexer.slot, notification.data.new_consumer_slot)
                 for other in (wr() for wr in self.ports):
                     if other is None or other is notification.sender or other.producer_slot is None:
@@ -227,9 +238,9 @@ class AudioBridge(object):
                     if notification.data.new_consumer_slot is not None:
                         self.mixer.connect_slots(other.producer_slot, notification.data.new_consumer_slot)
             if notification.data.producer_slot_changed:
-                if notification.data.old_producer_slot is not None:
+                if notification.data.old_producer_slot is not None and self.multiplexer is not None:
                     self.mixer.disconnect_slots(notification.data.old_producer_slot, self.multiplexer.slot)
-                if notification.data.new_producer_slot is not None:
+                if notification.data.new_producer_slot is not None and self.multiplexer is not None:
                     self.mixer.connect_slots(notification.data.new_producer_slot, self.multiplexer.slot)
                 for other in (wr() for wr in self.ports):
                     if other is None or other is notification.sender or other.consumer_slot is None:
@@ -239,6 +250,14 @@ class AudioBridge(object):
                     if notification.data.new_producer_slot is not None:
                         self.mixer.connect_slots(notification.data.new_producer_slot, other.consumer_slot)
 
+    def _create_multiplexers(self):
+        if self.multiplexer is not None or self._stopped:
+            return
+        self.multiplexer = MixerPort(self.mixer)
+        self.multiplexer.start()
+        self.demultiplexer = MixerPort(self.mixer)
+        self.demultiplexer.start()
+
     @staticmethod
     def _remove_port(selfwr, portwr):
         self = selfwr()
@@ -344,17 +363,356 @@ class RootAudioBridge(object):
                 self.ports.discard(portwr)
 
 
+class ActiveSpeakerAudioBridge(object):
+    """
+    An ActiveSpeakerAudioBridge is a container for objects providing the
+    IAudioPort interface, meant for large conferences. Unlike RootAudioBridge,
+    it doesn't connect all producers to all consumers. Instead it keeps a level
+    meter for each port and only connects the producers of the max_speakers
+    loudest ports to the consumers of all the other ports. Every consumer thus
+    receives the mix of the active speakers without its own audio, while the
+    number of connections and the mixing work grow linearly with the number of
+    ports.
+
+    A port which produces audio above level_threshold (on the 0-255 scale used
+    by the mixer) is considered active. The current speakers are kept until
+    ports which are louder replace them, and the levels are smoothed over
+    consecutive samples taken every level_interval seconds.
+
+    The mixer only reads the audio of the producers which are connected to at
+    least one consumer and reports a level of 0 for the others, so all the
+    producers are also connected to a MixerPort used as a meter, which makes
+    their levels available whether they are speakers or not.
+    """
+
+    implements(IObserver)
+
+    level_interval = 0.2
+    level_threshold = 2
+
+    def __init__(self, mixer, max_speakers=3):
+        self.mixer = mixer
+        self.max_speakers = max_speakers
+        self.meter = None
+        self.ports = set()
+        self.levels = {}
+        self.speakers = set()
+        self._lock = RLock()
+        self._timer = None
+        notification_center = NotificationCenter()
+        notification_center.add_observer(ObserverWeakrefProxy(self), name='AudioPortDidChangeSlots')
+
+    def __del__(self):
+        for speaker in (wr() for wr in self.speakers):
+            if speaker is None or speaker.producer_slot is None:
+                continue
+            for other in (wr() for wr in self.ports):
+                if other is None or other is speaker or other.consumer_slot is None:
+                    continue
+                self.mixer.disconnect_slots(speaker.producer_slot, other.consumer_slot)
+        if self.meter is not None:
+            for port in (wr() for wr in self.ports):
+                if port is not None and port.producer_slot is not None:
+                    self.mixer.disconnect_slots(port.producer_slot, self.meter.slot)
+            self.meter.stop()
+        self.ports.clear()
+        self.speakers.clear()
+
+    def __contains__(self, port):
+        return weakref.ref(port) in self.ports
+
+    def get_level(self, port):
+        """Return the smoothed level of the audio produced by port."""
+        with self._lock:
+            return self.levels.get(weakref.ref(port), 0)
+
+    def add(self, port):
+        with self._lock:
+            if not IAudioPort.providedBy(port):
+                raise TypeError("expected object implementing IAudioPort, got %s" % port.__class__.__name__)
+            if port.mixer is not self.mixer:
+                raise ValueError("expected port with Mixer %r, got %r" % (self.mixer, port.mixer))
+            if weakref.ref(port) in self.ports:
+                return
+            if port.consumer_slot is not None:
+                for speaker in (wr() for wr in self.speakers):
+                    if speaker is None or speaker.producer_slot is None:
+                        continue
+                    self.mixer.connect_slots(speaker.producer_slot, port.consumer_slot)
+            if port.producer_slot is not None:
+                self._create_meter()
+                self.mixer.connect_slots(port.producer_slot, self.meter.slot)
+            # See AudioBridge.add for why the callback only references ourselves weakly
+            portwr = weakref.ref(port, partial(self._remove_port, weakref.ref(self)))
+            self.ports.add(portwr)
+            self.levels[portwr] = 0
+            if len(self.speakers) < self.max_speakers and port.producer_slot is not None:
+                self._add_speaker(portwr)
+        self._start_sampling()
+
+    def remove(self, port):
+        with self._lock:
+            portwr = weakref.ref(port)
+            if portwr not in self.ports:
+                raise ValueError("port %r is not part of this bridge" % port)
+            if portwr in self.speakers:
+                self._remove_speaker(portwr)
+            if port.consumer_slot is not None:
+                for speaker in (wr() for wr in self.speakers):
+                    if speaker is None or speaker.producer_slot is None:
+                        continue
+                    self.mixer.disconnect_slots(speaker.producer_slot, port.consumer_slot)
+            if port.producer_slot is not None and self.meter is not None:
+                self.mixer.disconnect_slots(port.producer_slot, self.meter.slot)
+            self.ports.remove(portwr)
+            self.levels.pop(portwr, None)
+
+    def handle_notification(self, notification):
+        with self._lock:
+            portwr = weakref.ref(notification.sender)
+            if portwr not in self.ports:
+                return
+            if notification.data.consumer_slot_changed:
+                for speaker in (wr() for wr in self.speakers):
+                    if speaker is None or speaker is notification.sender or speaker.producer_slot is None:
+                        continue
+                    if notification.data.old_consumer_slot is not None:
+                        self.mixer.disconnect_slots(speaker.producer_slot, notification.data.old_consumer_slot)
+                    if notification.data.new_consumer_slot is not None:
+                        self.mixer.connect_slots(speaker.producer_slot, notification.data.new_consumer_slot)
+            if notification.data.producer_slot_changed:
+                if notification.data.old_producer_slot is not None and self.meter is not None:
+                    self.mixer.disconnect_slots(notification.data.old_producer_slot, self.meter.slot)
+                if notification.data.new_producer_slot is not None:
+                    self._create_meter()
+                    self.mixer.connect_slots(notification.data.new_producer_slot, self.meter.slot)
+            if notification.data.producer_slot_changed and portwr in self.speakers:
+                for other in (wr() for wr in self.ports):
+                    if other is None or other is notification.sender or other.consumer_slot is None:
+                        continue
+                    if notification.data.old_producer_slot is not None:
+                        self.mixer.disconnect_slots(notification.data.old_producer_slot, other.consumer_slot)
+                    if notification.data.new_producer_slot is not None:
+                        self.mixer.connect_slots(notification.data.new_producer_slot, other.consumer_slot)
+
+    def _create_meter(self):
+        if self.meter is None:
+            self.meter = MixerPort(self.mixer)
+            self.meter.start()
+
+    def _add_speaker(self, portwr):
+        port = portwr()
+        self.speakers.add(portwr)
+        if port is None or port.producer_slot is None:
+            return
+        for other in (wr() for wr in self.ports):
+            if other is None or other is port or other.consumer_slot is None:
+                continue
+            self.mixer.connect_slots(port.producer_slot, other.consumer_slot)
+
+    def _remove_speaker(self, portwr):
+        port = portwr()
+        self.speakers.discard(portwr)
+        if port is None or port.producer_slot is None:
+            return
+        for other in (wr() for wr in self.ports):
+            if other is None or other is port or other.consumer_slot is None:
+                continue
+            self.mixer.disconnect_slots(port.producer_slot, other.consumer_slot)
+
+    def _update_speakers(self):
+        def sort_key(portwr):
+            level = self.levels[portwr]
+            active = level >= self.level_threshold
+            return (active, level if active else 0, portwr in self.speakers)
+        candidates = [portwr for portwr in self.ports if portwr() is not None and portwr().producer_slot is not None]
+        speakers = set(sorted(candidates, key=sort_key, reverse=True)[:self.max_speakers])
+        for portwr in self.speakers - speakers:
+            self._remove_speaker(portwr)
+        for portwr in speakers - self.speakers:
+            self._add_speaker(portwr)
+
+    @run_in_twisted_thread
+    def _start_sampling(self):
+        from twisted.internet import reactor
+        with self._lock:
+            if self._timer is None and self.ports:
+                self._timer = reactor.callLater(self.level_interval, self._sample_levels, weakref.ref(self))
+
+    @staticmethod
+    def _sample_levels(selfwr):
+        self = selfwr()
+        if self is None:
+            return
+        with self._lock:
+            self._timer = None
+            for portwr in self.ports:
+                port = portwr()
+                level = 0
+                if port is not None and port.producer_slot is not None:
+                    try:
+                        level = self.mixer.get_signal_level(port.producer_slot)[1]
+                    except SIPCoreError:
+                        pass
+                self.levels[portwr] = (self.levels.get(portwr, 0) + level) / 2.0
+            self._update_speakers()
+        self._start_sampling()
+
+    @staticmethod
+    def _remove_port(selfwr, portwr):
+        self = selfwr()
+        if self is not None:
+            with self._lock:
+                self.ports.discard(portwr)
+                self.speakers.discard(portwr)
+                self.levels.pop(portwr, None)
+
+
+class LeastLoadedMixerPolicy(object):
+    """
+    A placement policy which assigns each audio stream to the mixer which has
+    the fewest streams assigned to it. Each mixer is clocked by its own thread,
+    so this spreads the mixing work over the available processors. A stream
+    stops counting against its mixer once it is released.
+
+    A stream can also be placed on a given mixer, such as the mixer of an
+    AudioConference, in which case it counts against that mixer if it is one
+    of the mixers of the policy.
+    """
+
+    def __init__(self, mixers):
+        if not mixers:
+            raise ValueError("at least one mixer is required")
+        self.mixers = list(mixers)
+        self.load = dict((mixer, 0) for mixer in self.mixers)
+        self._streams = set()
+        self._lock = RLock()
+
+    @property
+    def in_use(self):
+        with self._lock:
+            return any(self.load.itervalues())
+
+    def get_mixer(self, stream, mixer=None):
+        with self._lock:
+            if mixer is None:
+                mixer = min(self.mixers, key=self.load.__getitem__)
+            elif mixer not in self.load:
+                return mixer
+            self.load[mixer] += 1
+            self._streams.add(weakref.ref(stream, partial(self._release, weakref.ref(self), mixer)))
+            return mixer
+
+    @staticmethod
+    def _release(selfwr, mixer, streamwr):
+        self = selfwr()
+        if self is not None:
+            with self._lock:
+                self._streams.discard(streamwr)
+                self.load[mixer] -= 1
+
+
+class WaveCache(object):
+    """
+    A cache of the audio of WAV files, decoded to 16-bit mono samples, which
+    allows prompts and ringtones which are played over and over again to be
+    read from disk only once. The total size of the cached audio is limited to
+    max_size bytes, the least recently used files being evicted first. The
+    cache does not notice when a file changes on disk, invalidate() must be
+    called for it.
+    """
+
+    __metaclass__ = Singleton
+
+    max_size = 32*1024*1024
+
+    def __init__(self):
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._counter = count()
+        self._lock = RLock()
+
+    def get(self, filename):
+        """
+        Return the audio in the specified WAV file as a (data, sample_rate)
+        tuple, loading the file if it is not cached.
+        """
+        filename = os.path.realpath(filename)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None:
+                self.hits += 1
+                entry[0] = self._counter.next()
+                return entry[1], entry[2]
+            self.misses += 1
+        data, sample_rate = self._load(filename)
+        with self._lock:
+            if filename not in self._entries:
+                self._entries[filename] = [self._counter.next(), data, sample_rate]
+                self.size += len(data)
+                self._evict()
+        return data, sample_rate
+
+    def invalidate(self, filename):
+        filename = os.path.realpath(filename)
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        # the number of cached files is small, so a linear search for the least recently used one is good enough
+        while self.size > self.max_size and len(self._entries) > 1:
+            filename = min(self._entries, key=lambda name: self._entries[name][0])
+            self.size -= len(self._entries.pop(filename)[1])
+
+    def _load(self, filename):
+        wave_file = wave.open(filename, 'rb')
+        try:
+            channels = wave_file.getnchannels()
+            sample_width = wave_file.getsampwidth()
+            sample_rate = wave_file.getframerate()
+            data = wave_file.readframes(wave_file.getnframes())
+        finally:
+            wave_file.close()
+        if sample_width != 2:
+            data = audioop.lin2lin(data, sample_width, 2)
+        if channels == 2:
+            data = audioop.tomono(data, 2, 0.5, 0.5)
+        elif channels != 1:
+            raise wave.Error("unsupported number of channels: %d" % channels)
+        if sample_rate % 50 != 0:
+            # the audio is played in 20ms frames, which must contain a whole number of samples
+            data = audioop.ratecv(data, 2, 1, sample_rate, 16000, None)[0]
+            sample_rate = 16000
+        frame_size = sample_rate / 50 * 2
+        if len(data) % frame_size:
+            data += '\0' * (frame_size - len(data) % frame_size)
+        return data, sample_rate
+
+
 class WavePlayer(object):
     """
     An object capable of playing a WAV file. It can be used as part of an
     AudioBridge as it implements the IAudioPort interface.
+
+    If cached is True, the audio is played from the WaveCache, so that the file
+    is only read the first time it is played.
     """
 
     implements(IAudioPort, IObserver)
 
-    def __init__(self, mixer, filename, volume=100, loop_count=1, pause_time=0, initial_play=True):
+    def __init__(self, mixer, filename, volume=100, loop_count=1, pause_time=0, initial_play=True, cached=False):
         self.mixer = mixer
         self.filename = str(filename)
+        self.cached = cached
         self.initial_play = initial_play
         self.loop_count = loop_count
         self.pause_time = pause_time
@@ -403,7 +761,15 @@ class WavePlayer(object):
             while True:
                 command = self._channel.wait()
                 if command.name == 'play':
-                    self._wave_file = WaveFile(self.mixer, self.filename)
+                    if self.cached:
+                        try:
+                            data, sample_rate = WaveCache().get(self.filename)
+                        except (EnvironmentError, EOFError, wave.Error), e:
+                            notification_center.post_notification('WavePlayerDidFail', sender=self, data=TimestampedNotificationData(error=e))
+                            break
+                        self._wave_file = MemoryWaveFile(self.mixer, data, sample_rate, self.filename)
+                    else:
+                        self._wave_file = WaveFile(self.mixer, self.filename)
                     notification_center.add_observer(self, sender=self._wave_file, name='WaveFileDidFinishPlaying')
                     self._wave_file.volume = self.volume
                     try:
@@ -492,3 +858,124 @@ class WaveRecorder(object):
                                                                                                                        old_consumer_slot=old_slot, new_consumer_slot=None))
 
 
+class BufferedWaveRecorder(object):
+    """
+    An object capable of recording to a WAV file, which keeps the file I/O out
+    of the audio path: the mixer only copies the frames into a RecordingBuffer,
+    from which a writer thread collects them and writes them to the file in
+    large sequential writes. The audio can optionally be stored compressed,
+    using G.711 u-law or A-law. It can be used as part of an AudioBridge as it
+    implements the IAudioPort interface.
+
+    If the writer thread falls behind by more than the duration of the buffer,
+    the oldest frames are lost and are counted in dropped_frames.
+    """
+
+    implements(IAudioPort)
+
+    formats = {'pcm': (1, 2), 'ulaw': (7, 1), 'alaw': (6, 1)}
+    write_interval = 1.0
+
+    def __init__(self, mixer, filename, format='pcm', buffer_duration=10):
+        if format not in self.formats:
+            raise ValueError("unknown format: %s" % format)
+        self.mixer = mixer
+        self.filename = str(filename)
+        self.format = format
+        self.buffer_duration = buffer_duration
+        self._recording_buffer = None
+        self._dropped_frames = 0
+        self._thread = None
+        self._stopped = None
+
+    @property
+    def is_active(self):
+        return bool(self._recording_buffer and self._recording_buffer.is_active)
+
+    @property
+    def consumer_slot(self):
+        return self._recording_buffer.slot if self._recording_buffer else None
+
+    @property
+    def producer_slot(self):
+        return None
+
+    @property
+    def dropped_frames(self):
+        return self._recording_buffer.dropped_frames if self._recording_buffer else self._dropped_frames
+
+    def start(self):
+        if self._thread is not None:
+            return
+        makedirs(os.path.dirname(self.filename))
+        file = open(self.filename, 'wb')
+        self._write_header(file, 0)
+        recording_buffer = RecordingBuffer(self.mixer, self.buffer_duration)
+        try:
+            recording_buffer.start()
+        except SIPCoreError:
+            file.close()
+            raise
+        self._recording_buffer = recording_buffer
+        self._dropped_frames = 0
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, args=(recording_buffer, file, self._stopped), name='BufferedWaveRecorder writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=TimestampedNotificationData(consumer_slot_changed=True, producer_slot_changed=False,
+                                                                                                                       old_consumer_slot=None, new_consumer_slot=recording_buffer.slot))
+
+    def stop(self):
+        # the writer thread finishes the file on its own, so that the caller doesn't wait for the last write
+        if self._thread is None:
+            return
+        old_slot = self.consumer_slot
+        self._recording_buffer = None
+        self._thread = None
+        self._stopped.set()
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=TimestampedNotificationData(consumer_slot_changed=True, producer_slot_changed=False,
+                                                                                                                       old_consumer_slot=old_slot, new_consumer_slot=None))
+
+    def _run(self, recording_buffer, file, stopped):
+        data_size = 0
+        try:
+            while not stopped.isSet():
+                stopped.wait(self.write_interval)
+                data_size += self._write(file, recording_buffer.read())
+            # collect whatever was recorded since the last write before closing the file
+            data_size += self._write(file, recording_buffer.read())
+            self._write_header(file, data_size)
+        finally:
+            recording_buffer.stop()
+            self._dropped_frames = recording_buffer.dropped_frames
+            file.close()
+        NotificationCenter().post_notification('BufferedWaveRecorderDidEnd', sender=self, data=TimestampedNotificationData(dropped_frames=self._dropped_frames))
+
+    def _write(self, file, data):
+        if not data:
+            return 0
+        if self.format == 'ulaw':
+            data = audioop.lin2ulaw(data, 2)
+        elif self.format == 'alaw':
+            data = audioop.lin2alaw(data, 2)
+        file.write(data)
+        return len(data)
+
+    def _write_header(self, file, data_size):
+        format_tag, sample_width = self.formats[self.format]
+        sample_rate = self.mixer.sample_rate
+        if format_tag == 1:
+            format_chunk = struct.pack('<4sIHHIIHH', 'fmt ', 16, format_tag, 1, sample_rate, sample_rate*sample_width, sample_width, sample_width*8)
+            fact_chunk = ''
+        else:
+            # non-PCM formats need the extension size field and a fact chunk
+            format_chunk = struct.pack('<4sIHHIIHHH', 'fmt ', 18, format_tag, 1, sample_rate, sample_rate*sample_width, sample_width, sample_width*8, 0)
+            fact_chunk = struct.pack('<4sII', 'fact', 4, data_size / sample_width)
+        header = struct.pack('<4sI4s', 'RIFF', 4 + len(format_chunk) + len(fact_chunk) + 8 + data_size, 'WAVE') + format_chunk + fact_chunk + struct.pack('<4sI', 'data', data_size)
+        file.seek(0)
+        file.write(header)
+        file.seek(0, os.SEEK_END)
+
+
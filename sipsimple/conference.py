@@ -11,24 +11,40 @@ __all__ = ['AudioConference']
 
 from threading import RLock
 
-from sipsimple.application import SIPApplication
-from sipsimple.audio import AudioDevice, RootAudioBridge
+from sipsimple.audio import ActiveSpeakerAudioBridge, AudioDevice
 
 
 class AudioConference(object):
-    def __init__(self):
-        self.bridge = RootAudioBridge(SIPApplication.voice_audio_mixer)
-        self.device = AudioDevice(SIPApplication.voice_audio_mixer)
+    """
+    Mixes the audio of several AudioStreams and of the local audio device.
+    Only the audio of the max_speakers loudest participants is mixed, each
+    participant receiving the audio of the active speakers except its own.
+    All the streams must use the mixer of the conference, which is the one
+    given or otherwise the mixer of the first stream which is added. The
+    streams can be placed on it by creating them as AudioStream(account,
+    mixer=conference.mixer).
+    """
+
+    def __init__(self, max_speakers=3, mixer=None):
+        self.max_speakers = max_speakers
+        self.mixer = None
+        self.bridge = None
+        self.device = None
         self.on_hold = False
         self.streams = []
         self._lock = RLock()
 
-        self.bridge.add(self.device)
+        if mixer is not None:
+            self._create_bridge(mixer)
 
     def add(self, stream):
         with self._lock:
             if stream in self.streams:
                 return
+            if self.bridge is None:
+                self._create_bridge(stream.mixer)
+            elif stream.mixer is not self.mixer:
+                raise ValueError("stream %r does not use the mixer of the conference" % stream)
             stream.bridge.remove(stream.device)
             self.bridge.add(stream.bridge)
             self.streams.append(stream)
@@ -43,14 +59,21 @@ class AudioConference(object):
         with self._lock:
             if self.on_hold:
                 return
-            self.bridge.remove(self.device)
+            if self.bridge is not None:
+                self.bridge.remove(self.device)
             self.on_hold = True
 
     def unhold(self):
         with self._lock:
             if not self.on_hold:
                 return
-            self.bridge.add(self.device)
+            if self.bridge is not None:
+                self.bridge.add(self.device)
             self.on_hold = False
 
-
+    def _create_bridge(self, mixer):
+        self.mixer = mixer
+        self.bridge = ActiveSpeakerAudioBridge(mixer, max_speakers=self.max_speakers)
+        self.device = AudioDevice(mixer)
+        if not self.on_hold:
+            self.bridge.add(self.device)
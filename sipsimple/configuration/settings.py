@@ -27,10 +27,11 @@ class AudioSettings(SettingsGroup):
     tail_length = Setting(type=NonNegativeInteger, default=200)
     sample_rate = Setting(type=SampleRate, default=44100)
     silent = Setting(type=bool, default=False)
+    headless_mixer_count = Setting(type=NonNegativeInteger, default=0)
 
 
 class ChatSettings(SettingsGroup):
-    pass
+    max_outstanding_transactions = Setting(type=NonNegativeInteger, default=10)
 
 
 class DesktopSharingSettings(SettingsGroup):
@@ -43,6 +44,7 @@ class FileTransferSettings(SettingsGroup):
 
 class LogsSettings(SettingsGroup):
     pjsip_level = Setting(type=PJSIPLogLevel, default=5)
+    trace_msrp = Setting(type=bool, default=True)
 
 
 class RTPSettings(SettingsGroup):
@@ -61,6 +63,11 @@ class SIPSettings(SettingsGroup):
     tcp_port = CorrelatedSetting(type=Port, sibling='tls_port', validator=sip_port_validator, default=0)
     tls_port = CorrelatedSetting(type=Port, sibling='tcp_port', validator=sip_port_validator, default=0)
     transport_list = Setting(type=SIPTransportList, default=SIPTransportList(('tls', 'tcp', 'udp')))
+    register_concurrency = Setting(type=NonNegativeInteger, default=20)
+    register_rate_limit = Setting(type=NonNegativeInteger, default=10)
+    # a value of 0 means no limit for the shutdown concurrency and no timeout for the shutdown
+    shutdown_concurrency = Setting(type=NonNegativeInteger, default=50)
+    shutdown_timeout = Setting(type=NonNegativeInteger, default=10)
 
 
 class TLSSettings(SettingsGroup):
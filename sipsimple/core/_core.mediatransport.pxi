@@ -14,6 +14,7 @@ cdef class RTPTransport:
         cdef pjsip_endpoint *endpoint
         cdef PJSIPUA ua
 
+        _object_counts["RTPTransport"] += 1
         ua = _get_ua()
         endpoint = ua._pjsip_endpoint._obj
         pool_name = "RTPTransport_%d" % id(self)
@@ -55,6 +56,7 @@ cdef class RTPTransport:
         cdef pj_pool_t *pool
         cdef Timer timer
 
+        _object_counts["RTPTransport"] -= 1
         try:
             ua = _get_ua()
         except SIPCoreError:
@@ -495,6 +497,7 @@ cdef class AudioTransport:
         cdef pjsip_endpoint *endpoint
         cdef PJSIPUA ua
 
+        _object_counts["AudioTransport"] += 1
         ua = _get_ua()
         endpoint = ua._pjsip_endpoint._obj
         pool_name = "AudioTransport_%d" % id(self)
@@ -571,6 +574,8 @@ cdef class AudioTransport:
     def __dealloc__(self):
         cdef PJSIPUA ua
         cdef Timer timer
+
+        _object_counts["AudioTransport"] -= 1
         try:
             ua = _get_ua()
         except SIPCoreError:
@@ -589,6 +594,34 @@ cdef class AudioTransport:
         except SIPCoreError:
             pass
 
+    cdef int _get_statistics(self, unsigned int *row) except -1:
+        # Writes the statistics in row and returns 1, or returns 0 if the stream is not started
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_rtcp_stat stat
+        cdef pjmedia_stream *stream
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            stream = self._obj
+
+            if stream == NULL:
+                return 0
+            with nogil:
+                status = pjmedia_stream_get_stat(stream, &stat)
+            if status != 0:
+                return 0
+            row = _pj_math_stat_to_row(&stat.rtt, row)
+            row = _pjmedia_rtcp_stream_stat_to_row(&stat.rx, row)
+            row = _pjmedia_rtcp_stream_stat_to_row(&stat.tx, row)
+            return 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
     cdef PJSIPUA _check_ua(self):
         cdef PJSIPUA ua
         try:
@@ -852,6 +885,7 @@ cdef class AudioTransport:
                 local_media = pjmedia_sdp_media_clone(pool, pj_local_sdp.media[sdp_index])
             self._local_media = local_media
             self._is_started = 1
+            self.mixer._audio_transports[id(self)] = self.weakref
             if no_media_timeout > 0:
                 self._timer = MediaCheckTimer(media_check_interval)
                 self._timer.schedule(no_media_timeout, <timer_callback>self._cb_check_rtp, self)
@@ -881,6 +915,7 @@ cdef class AudioTransport:
             if self._obj == NULL:
                 return
             self.mixer._remove_port(ua, self._slot)
+            self.mixer._audio_transports.pop(id(self), None)
             self._cached_statistics = self.statistics
             with nogil:
                 pjmedia_stream_destroy(stream)
@@ -1004,6 +1039,37 @@ cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_sta
     retval["jitter"] = _pj_math_stat_to_dict(&stream_stat.jitter)
     return retval
 
+cdef unsigned int *_pj_math_stat_to_row(pj_math_stat *stat, unsigned int *row):
+    row[0] = stat.n
+    row[1] = stat.max
+    row[2] = stat.min
+    row[3] = stat.last
+    row[4] = stat.mean
+    return row + 5
+
+cdef unsigned int *_pjmedia_rtcp_stream_stat_to_row(pjmedia_rtcp_stream_stat *stream_stat, unsigned int *row):
+    row[0] = stream_stat.pkt
+    row[1] = stream_stat.bytes
+    row[2] = stream_stat.discard
+    row[3] = stream_stat.loss
+    row[4] = stream_stat.reorder
+    row[5] = stream_stat.dup
+    row = _pj_math_stat_to_row(&stream_stat.loss_period, row + 6)
+    row[0] = stream_stat.loss_type.burst
+    row[1] = stream_stat.loss_type.random
+    return _pj_math_stat_to_row(&stream_stat.jitter, row + 2)
+
+# The layout of the rows written by AudioMixer.get_rtp_statistics, which follows
+# the structure of the dictionary returned by AudioTransport.statistics
+_math_stat_fields = ("count", "max", "min", "last", "avg")
+_stream_stat_fields = (("packets", "bytes", "packets_discarded", "packets_lost", "packets_reordered", "packets_duplicate") +
+                       tuple(["loss_period_%s" % field for field in _math_stat_fields]) + ("burst_loss", "random_loss") +
+                       tuple(["jitter_%s" % field for field in _math_stat_fields]))
+RTP_STATISTICS_FIELDS = (tuple(["rtt_%s" % field for field in _math_stat_fields]) +
+                         tuple(["rx_%s" % field for field in _stream_stat_fields]) +
+                         tuple(["tx_%s" % field for field in _stream_stat_fields]))
+del _math_stat_fields, _stream_stat_fields
+
 # callback functions
 
 cdef void _RTPTransport_cb_ice_complete(pjmedia_transport *tp, pj_ice_strans_op op, int status) with gil:
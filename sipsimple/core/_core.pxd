@@ -22,6 +22,7 @@ cdef extern from "Python.h":
     void Py_DECREF(object obj)
     object PyString_FromStringAndSize(char *v, int len)
     char* PyString_AsString(object string) except NULL
+    int PyObject_AsWriteBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
     void* PyLong_AsVoidPtr(object)
     object PyLong_FromVoidPtr(void*)
     double PyFloat_AsDouble(object)
@@ -320,6 +321,7 @@ cdef extern from "pjmedia.h":
     int pjmedia_conf_disconnect_port(pjmedia_conf *conf, unsigned int src_slot, unsigned int sink_slot) nogil
     int pjmedia_conf_adjust_rx_level(pjmedia_conf *conf, unsigned slot, int adj_level) nogil
     int pjmedia_conf_adjust_tx_level(pjmedia_conf *conf, unsigned slot, int adj_level) nogil
+    int pjmedia_conf_get_signal_level(pjmedia_conf *conf, unsigned slot, unsigned int *tx_level, unsigned int *rx_level) nogil
 
     # sdp
     enum:
@@ -498,6 +500,15 @@ cdef extern from "pjmedia.h":
                                       int cb(pjmedia_port *port, void *usr_data) with gil) nogil
     int pjmedia_wav_player_port_set_pos(pjmedia_port *port, unsigned int offset) nogil
 
+    # memory player
+    enum:
+        PJMEDIA_MEM_NO_LOOP
+    int pjmedia_mem_player_create(pj_pool_t *pool, void *buffer, unsigned int size, unsigned int clock_rate,
+                                  unsigned int channel_count, unsigned int samples_per_frame,
+                                  unsigned int bits_per_sample, unsigned int options, pjmedia_port **p_port) nogil
+    int pjmedia_mem_player_set_eof_cb(pjmedia_port *port, void *user_data,
+                                      int cb(pjmedia_port *port, void *usr_data) with gil) nogil
+
     # wav recorder
     enum pjmedia_file_writer_option:
         PJMEDIA_FILE_WRITE_PCM
@@ -506,6 +517,14 @@ cdef extern from "pjmedia.h":
                                        unsigned int bits_per_sample, unsigned int flags, int buff_size,
                                        pjmedia_port **p_port) nogil
 
+    # memory capture
+    int pjmedia_mem_capture_create(pj_pool_t *pool, void *buffer, unsigned int size, unsigned int clock_rate,
+                                   unsigned int channel_count, unsigned int samples_per_frame,
+                                   unsigned int bits_per_sample, unsigned int options, pjmedia_port **p_port) nogil
+    int pjmedia_mem_capture_set_eof_cb(pjmedia_port *port, void *user_data,
+                                       int cb(pjmedia_port *port, void *usr_data) nogil) nogil
+    unsigned int pjmedia_mem_capture_get_size(pjmedia_port *port) nogil
+
     # tone generator
     enum:
         PJMEDIA_TONEGEN_MAX_DIGITS
@@ -1411,6 +1430,7 @@ cdef class AudioMixer(object):
     cdef pjmedia_port *_null_port
     cdef pjmedia_snd_port *_snd
     cdef list _connected_slots
+    cdef dict _audio_transports
     cdef readonly int ec_tail_length
     cdef readonly int sample_rate
     cdef readonly int slot_count
@@ -1474,6 +1494,11 @@ cdef class WaveFile(object):
     cdef int _stop(self, PJSIPUA ua, int notify) except -1
     cdef int _cb_eof(self, timer) except -1
 
+cdef class MemoryWaveFile(WaveFile):
+    # attributes
+    cdef readonly str data
+    cdef readonly int sample_rate
+
 cdef class MixerPort(object):
     cdef int _slot
     cdef int _was_started
@@ -1486,8 +1511,27 @@ cdef class MixerPort(object):
     cdef PJSIPUA _check_ua(self)
     cdef int _stop(self, PJSIPUA ua) except -1
 
+cdef class RecordingBuffer(object):
+    cdef int _slot
+    cdef int _was_started
+    cdef unsigned long long _wraps
+    cdef unsigned long long _read_position
+    cdef char *_buffer
+    cdef pj_mutex_t *_lock
+    cdef pj_pool_t *_pool
+    cdef pjmedia_port *_port
+    cdef readonly unsigned int buffer_size
+    cdef readonly unsigned int frame_size
+    cdef readonly unsigned long long dropped_frames
+    cdef readonly AudioMixer mixer
+
+    # private methods
+    cdef PJSIPUA _check_ua(self)
+    cdef int _stop(self, PJSIPUA ua) except -1
+
 cdef int _AudioMixer_dealloc_handler(object obj) except -1
 cdef int cb_play_wav_eof(pjmedia_port *port, void *user_data) with gil
+cdef int _RecordingBuffer_cb_wrap(pjmedia_port *port, void *user_data) nogil
 
 # core.event
 
@@ -1870,6 +1914,7 @@ cdef class AudioTransport(object):
 
     # private methods
     cdef PJSIPUA _check_ua(self)
+    cdef int _get_statistics(self, unsigned int *row) except -1
     cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1 with gil
 
 cdef void _RTPTransport_cb_ice_complete(pjmedia_transport *tp, pj_ice_strans_op op, int status) with gil
@@ -1879,3 +1924,5 @@ cdef void _RTPTransport_cb_ice_state(pjmedia_transport *tp, char *state) with gi
 cdef void _AudioTransport_cb_dtmf(pjmedia_stream *stream, void *user_data, int digit) with gil
 cdef dict _pj_math_stat_to_dict(pj_math_stat *stat)
 cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_stat)
+cdef unsigned int *_pj_math_stat_to_row(pj_math_stat *stat, unsigned int *row)
+cdef unsigned int *_pjmedia_rtcp_stream_stat_to_row(pjmedia_rtcp_stream_stat *stream_stat, unsigned int *row)
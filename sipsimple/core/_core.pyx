@@ -29,7 +29,7 @@ CORE_REVISION = 120
 
 __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION",
            "SIPCoreError", "PJSIPError", "PJSIPTLSError", "SIPCoreInvalidStateError",
-           "AudioMixer", "ToneGenerator", "RecordingWaveFile", "WaveFile", "MixerPort",
+           "AudioMixer", "ToneGenerator", "RecordingWaveFile", "WaveFile", "MemoryWaveFile", "MixerPort", "RecordingBuffer", "RTP_STATISTICS_FIELDS",
            "sip_status_messages",
            "BaseCredentials", "Credentials", "FrozenCredentials", "BaseSIPURI", "SIPURI", "FrozenSIPURI",
            "BaseHeader", "Header", "FrozenHeader", "BaseContactHeader", "ContentType", "ContactHeader", "FrozenContactHeader",
@@ -42,7 +42,8 @@ __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION",
            "Subscription",
            "Invitation",
            "SDPSession", "FrozenSDPSession", "SDPMediaStream", "FrozenSDPMediaStream", "SDPConnection", "FrozenSDPConnection", "SDPAttribute", "FrozenSDPAttribute",
-           "RTPTransport", "AudioTransport"]
+           "RTPTransport", "AudioTransport",
+           "get_object_counts"]
 
 
 # Initialize the GIL in the PyMODINIT function of the module.
@@ -2,6 +2,7 @@
 #
 
 import platform
+from array import array
 
 
 # classes
@@ -134,6 +135,7 @@ cdef class AudioMixer:
 
     def __cinit__(self, *args, **kwargs):
         self._connected_slots = list()
+        self._audio_transports = dict()
         if platform.system() == "Darwin":
             # At some point Snow Leopard did not like this, but it works now 2010-09-05
             # and not platform.mac_ver()[0].startswith("10.6"):
@@ -302,6 +304,74 @@ cdef class AudioMixer:
             with nogil:
                 pj_mutex_unlock(lock)
 
+    def get_signal_level(self, int slot):
+        cdef int status
+        cdef unsigned int tx_level
+        cdef unsigned int rx_level
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_conf *conf_bridge
+        cdef PJSIPUA ua
+
+        ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            conf_bridge = self._obj
+
+            if slot < 0:
+                raise ValueError("slot argument cannot be negative")
+            with nogil:
+                status = pjmedia_conf_get_signal_level(conf_bridge, slot, &tx_level, &rx_level)
+            if status != 0:
+                raise PJSIPError("Could not get signal level of slot on audio mixer", status)
+            return (tx_level, rx_level)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def get_rtp_statistics(self, object buffer=None, int offset=0):
+        """
+        Take a snapshot of the RTP statistics of all the started AudioTransports
+        which use this mixer. The statistics of each transport are written as
+        a row of len(RTP_STATISTICS_FIELDS) unsigned 32-bit integers, starting
+        at row offset, in buffer, which can be any writable buffer such as an
+        array.array('I') or a numpy uint32 array. If buffer is None, a new
+        array of the required size is allocated.
+
+        Returns a tuple with the list of the AudioTransports whose statistics
+        were written, in the order of the rows, and the buffer.
+        """
+        cdef int field_count = len(RTP_STATISTICS_FIELDS)
+        cdef unsigned int *rows
+        cdef void *data
+        cdef Py_ssize_t length
+        cdef list transports = list()
+        cdef list captured = list()
+        cdef AudioTransport transport
+
+        if offset < 0:
+            raise ValueError("offset argument cannot be negative")
+        for transport_id, transport_ref in self._audio_transports.items():
+            transport = transport_ref()
+            if transport is None:
+                del self._audio_transports[transport_id]
+            else:
+                transports.append(transport)
+        if buffer is None:
+            buffer = array('I', [0]) * ((offset + len(transports)) * field_count)
+        PyObject_AsWriteBuffer(buffer, &data, &length)
+        if length < (offset + len(transports)) * field_count * sizeof(unsigned int):
+            raise ValueError("buffer is too small for the statistics of %d transports" % len(transports))
+        rows = (<unsigned int *> data) + offset * field_count
+        for transport in transports:
+            if transport._get_statistics(rows):
+                captured.append(transport)
+                rows += field_count
+        return captured, buffer
+
     # private methods
 
     cdef int _start_sound_device(self, PJSIPUA ua, str input_device, str output_device,
@@ -1237,8 +1307,89 @@ cdef class WaveFile:
                 pj_mutex_unlock(lock)
 
 
+cdef class MemoryWaveFile(WaveFile):
+    """
+    A WaveFile which plays audio already loaded in memory instead of reading
+    it from a file, so that the same audio can be played by any number of
+    ports without any file I/O. The data must be 16-bit signed mono samples
+    at the given sample rate. The filename attribute is only used to identify
+    the audio.
+    """
+
+    def __init__(self, AudioMixer mixer, str data, int sample_rate, str filename="<memory>"):
+        if self.filename is not None:
+            raise SIPCoreError("MemoryWaveFile.__init__() was already called")
+        if mixer is None:
+            raise ValueError("mixer argument may not be None")
+        if data is None:
+            raise ValueError("data argument may not be None")
+        if sample_rate <= 0:
+            raise ValueError("sample_rate argument should be a positive integer")
+        self.mixer = mixer
+        self.data = data
+        self.sample_rate = sample_rate
+        self.filename = filename
+
+    def start(self):
+        cdef char *data
+        cdef int status
+        cdef unsigned int size
+        cdef unsigned int sample_rate
+        cdef void *weakref
+        cdef pj_pool_t *pool
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_port **port_address
+        cdef pjsip_endpoint *endpoint
+        cdef str pool_name
+        cdef PJSIPUA ua
+
+        ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            endpoint = ua._pjsip_endpoint._obj
+            data = PyString_AsString(self.data)
+            size = len(self.data)
+            sample_rate = self.sample_rate
+            port_address = &self._port
+            weakref = <void *> self.weakref
+
+            if self._port != NULL:
+                raise SIPCoreError("WAV file is already playing")
+            pool_name = "MemoryWaveFile_%d" % id(self)
+            with nogil:
+                pool = pjsip_endpt_create_pool(endpoint, pool_name, 4096, 4096)
+            if pool == NULL:
+                raise SIPCoreError("Could not allocate memory pool")
+            self._pool = pool
+            try:
+                # the port plays directly from the data string, which is kept alive by this object
+                with nogil:
+                    status = pjmedia_mem_player_create(pool, <void *> data, size, sample_rate, 1, sample_rate / 50, 16,
+                                                       PJMEDIA_MEM_NO_LOOP, port_address)
+                if status != 0:
+                    raise PJSIPError("Could not create memory player", status)
+                with nogil:
+                    status = pjmedia_mem_player_set_eof_cb(port_address[0], weakref, cb_play_wav_eof)
+                if status != 0:
+                    raise PJSIPError("Could not set memory player EOF callback", status)
+                self._slot = self.mixer._add_port(ua, self._pool, self._port)
+                if self._volume != 100:
+                    self.volume = self._volume
+            except:
+                self._stop(ua, 0)
+                raise
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+
 cdef class MixerPort:
     def __cinit__(self, *args, **kwargs):
+        _object_counts["MixerPort"] += 1
         pj_mutex_create_recursive(_get_ua()._pjsip_endpoint._pool, "mixer_port_lock", &self._lock)
         self._slot = -1
 
@@ -1359,6 +1510,220 @@ cdef class MixerPort:
             self._pool = NULL
         return 0
 
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+
+        _object_counts["MixerPort"] -= 1
+        try:
+            ua = _get_ua()
+        except:
+            return
+
+        self._stop(ua)
+        pj_mutex_destroy(self._lock)
+
+
+cdef class RecordingBuffer:
+    """
+    A port which records the audio it receives from the mixer into a ring
+    buffer in memory. The mixer only copies each frame into the buffer, while
+    the recorded audio is consumed by calling read() from another thread. If
+    the audio is not read fast enough, the oldest frames are overwritten and
+    counted in dropped_frames.
+    """
+
+    def __cinit__(self, *args, **kwargs):
+        pj_mutex_create_recursive(_get_ua()._pjsip_endpoint._pool, "recording_buffer_lock", &self._lock)
+        self._slot = -1
+
+    def __init__(self, AudioMixer mixer, int duration=10):
+        if self.mixer is not None:
+            raise SIPCoreError("RecordingBuffer.__init__() was already called")
+        if mixer is None:
+            raise ValueError("mixer argument may not be None")
+        if duration <= 0:
+            raise ValueError("duration argument should be a positive integer")
+        self.mixer = mixer
+        self.frame_size = mixer.sample_rate / 50 * 2
+        self.buffer_size = duration * 50 * self.frame_size
+
+    cdef PJSIPUA _check_ua(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+            return ua
+        except:
+            self._pool = NULL
+            self._port = NULL
+            self._slot = -1
+            return None
+
+    property is_active:
+
+        def __get__(self):
+            self._check_ua()
+            return self._slot != -1
+
+    property slot:
+
+        def __get__(self):
+            self._check_ua()
+            if self._slot == -1:
+                return None
+            else:
+                return self._slot
+
+    def start(self):
+        cdef int sample_rate
+        cdef int status
+        cdef unsigned int buffer_size
+        cdef void *buffer
+        cdef pj_mutex_t *lock = self._lock
+        cdef pj_pool_t *pool
+        cdef pjmedia_port **port_address
+        cdef pjsip_endpoint *endpoint
+        cdef str pool_name
+        cdef PJSIPUA ua
+
+        ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            endpoint = ua._pjsip_endpoint._obj
+            pool_name = "RecordingBuffer_%d" % id(self)
+            port_address = &self._port
+            sample_rate = self.mixer.sample_rate
+            buffer_size = self.buffer_size
+
+            if self._was_started:
+                raise SIPCoreError("This RecordingBuffer was already started once")
+            with nogil:
+                pool = pjsip_endpt_create_pool(endpoint, pool_name, 4096, 4096)
+            if pool == NULL:
+                raise SIPCoreError("Could not allocate memory pool")
+            self._pool = pool
+            try:
+                with nogil:
+                    buffer = pj_pool_alloc(pool, buffer_size)
+                if buffer == NULL:
+                    raise SIPCoreError("Could not allocate recording buffer")
+                self._buffer = <char *> buffer
+                with nogil:
+                    status = pjmedia_mem_capture_create(pool, buffer, buffer_size, sample_rate, 1,
+                                                        sample_rate / 50, 16, 0, port_address)
+                if status != 0:
+                    raise PJSIPError("Could not create recording buffer", status)
+                with nogil:
+                    status = pjmedia_mem_capture_set_eof_cb(port_address[0], <void *> &self._wraps, _RecordingBuffer_cb_wrap)
+                if status != 0:
+                    raise PJSIPError("Could not set callback on recording buffer", status)
+                self._slot = self.mixer._add_port(ua, self._pool, self._port)
+            except:
+                self.stop()
+                raise
+            self._was_started = 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def read(self):
+        """
+        Return the audio recorded since the previous call, as a string of
+        16-bit signed mono samples.
+        """
+        cdef int status
+        cdef unsigned int offset
+        cdef unsigned int length
+        cdef unsigned int first_length
+        cdef unsigned long long written
+        cdef unsigned long long overflow
+        cdef char *data
+        cdef char *buffer = self._buffer
+        cdef object result
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_port *port
+
+        self._check_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            port = self._port
+
+            if port == NULL:
+                return ""
+            written = self._wraps * self.buffer_size + pjmedia_mem_capture_get_size(port)
+            if written <= self._read_position:
+                # the buffer has just wrapped around, the wrap is not counted yet
+                return ""
+            # leave out the frame which may be in the process of being overwritten
+            if written - self._read_position > self.buffer_size - self.frame_size:
+                overflow = written - self._read_position - (self.buffer_size - self.frame_size)
+                overflow += (self.frame_size - overflow % self.frame_size) % self.frame_size
+                self._read_position += overflow
+                self.dropped_frames += overflow / self.frame_size
+            length = written - self._read_position
+            offset = self._read_position % self.buffer_size
+            result = PyString_FromStringAndSize(NULL, length)
+            data = PyString_AsString(result)
+            first_length = min(length, self.buffer_size - offset)
+            with nogil:
+                memcpy(data, buffer + offset, first_length)
+                if first_length < length:
+                    memcpy(data + first_length, buffer, length - first_length)
+            self._read_position = written
+            return result
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def stop(self):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef PJSIPUA ua
+
+        ua = self._check_ua()
+        if ua is None:
+            return
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._stop(ua)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    cdef int _stop(self, PJSIPUA ua) except -1:
+        cdef pj_pool_t *pool
+        cdef pjmedia_port *port
+        cdef pjsip_endpoint *endpoint
+
+        endpoint = ua._pjsip_endpoint._obj if ua is not None else NULL
+        pool = self._pool
+        port = self._port
+
+        if self._slot != -1:
+            self.mixer._remove_port(ua, self._slot)
+            self._slot = -1
+        if self._port != NULL:
+            with nogil:
+                pjmedia_port_destroy(port)
+            self._port = NULL
+        self._buffer = NULL
+        if self._pool != NULL:
+            with nogil:
+                pjsip_endpt_release_pool(endpoint, pool)
+            self._pool = NULL
+        return 0
+
     def __dealloc__(self):
         cdef PJSIPUA ua
         try:
@@ -1399,3 +1764,8 @@ cdef int cb_play_wav_eof(pjmedia_port *port, void *user_data) with gil:
         timer.schedule(0, <timer_callback>wav_file._cb_eof, wav_file)
     # do not return PJ_SUCCESS because if you do pjsip will access the just deallocated port
     return 1
+
+cdef int _RecordingBuffer_cb_wrap(pjmedia_port *port, void *user_data) nogil:
+    # called from the mixer's clock thread each time the ring buffer wraps around
+    (<unsigned long long *> user_data)[0] += 1
+    return 0
@@ -364,8 +364,16 @@ cdef int _BaseRouteHeader_to_pjsip_route_hdr(BaseIdentityHeader header, pjsip_ro
     _dict_to_pjsip_param(header.parameters, &pj_header.other_param, pool)
     return 0
 
+def get_object_counts():
+    """
+    Return a dictionary with the number of RTPTransport, AudioTransport and
+    MixerPort objects which are currently alive, to help tracking down leaks.
+    """
+    return dict(_object_counts)
+
 # globals
 
+cdef dict _object_counts = dict(RTPTransport=0, AudioTransport=0, MixerPort=0)
 cdef object _re_pj_status_str_def = re.compile("^.*\((.*)\)$")
 cdef object _re_warning_hdr = re.compile('(?P<code>[0-9]{3}) (?P<agent>.*?) "(?P<text>.*?)"')
 sip_status_messages = SIPStatusMessages()
@@ -8,10 +8,13 @@ hop(s) and failover for routing of SIP messages and reservation of network
 resources prior the starting of a SIP session.
 """
 
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
+import os
 import re
+import struct
 from itertools import chain
+from threading import RLock
 from time import time
 from urlparse import urlparse
 
@@ -42,9 +45,11 @@ dns.query.socket = socket
 
 from application.notification import NotificationCenter
 from application.python.decorator import decorator, preserve_signature
+from application.python.util import Singleton
 from dns import exception, rdatatype
+from twisted.internet.protocol import DatagramProtocol
 
-from sipsimple.util import Route, TimestampedNotificationData, limit, run_in_waitable_green_thread
+from sipsimple.util import Route, TimestampedNotificationData, limit, positive_infinite, run_in_twisted_thread, run_in_waitable_green_thread
 
 
 def domain_iterator(domain):
@@ -103,18 +108,318 @@ class DNSCache(object):
             self.data = {}
 
 
+class RouteStatus(object):
+    """
+    Internal object used to save the outcome of the requests sent over a route.
+    """
+    def __init__(self):
+        self.last_success = None
+        self.last_failure = None
+        self.failures = 0
+        self.retry_time = 0
+
+
+class RouteHealthCache(object):
+    """
+    Keeps track of the outcome of the requests sent over the routes of each
+    domain. The routes which worked last are tried first, so that the
+    connections already established to them are reused, while the ones which
+    failed recently are tried last until their exponential backoff expires.
+    """
+
+    __metaclass__ = Singleton
+
+    max_backoff = 300
+
+    def __init__(self):
+        self.data = {}
+
+    def sort_routes(self, domain, routes):
+        """
+        Return the routes obtained for domain, in the order in which they
+        should be tried.
+        """
+        statuses = self.data.get(domain)
+        if not statuses:
+            return list(routes)
+        now = time()
+        def sort_key(item):
+            index, route = item
+            status = statuses.get((route.address, route.port, route.transport))
+            if status is None:
+                return (1, 0, index)
+            elif status.retry_time > now:
+                return (2, status.retry_time, index)
+            elif status.failures == 0 and status.last_success is not None:
+                return (0, -status.last_success, index)
+            else:
+                return (1, 0, index)
+        return [route for index, route in sorted(enumerate(routes), key=sort_key)]
+
+    def success(self, domain, route):
+        status = self.data.setdefault(domain, {}).setdefault((route.address, route.port, route.transport), RouteStatus())
+        status.last_success = time()
+        status.failures = 0
+        status.retry_time = 0
+
+    @staticmethod
+    def is_route_failure(code):
+        """
+        Return whether a request which failed with the specified response code
+        indicates a problem with the route: a timeout, a transport error or a
+        server error. The other failures come from a server which answered.
+        """
+        return not code or code == 408 or code >= 500
+
+    def failure(self, domain, route):
+        status = self.data.setdefault(domain, {}).setdefault((route.address, route.port, route.transport), RouteStatus())
+        status.last_failure = time()
+        status.failures += 1
+        status.retry_time = status.last_failure + limit(2**status.failures, max=self.max_backoff)
+
+    def get_status(self, domain):
+        """
+        Return a dictionary mapping the (address, port, transport) tuples of
+        the known routes of domain to objects describing their status.
+        """
+        return dict(self.data.get(domain, {}))
+
+    def flush(self, domain=None):
+        if domain is not None:
+            self.data.pop(domain, None)
+        else:
+            self.data = {}
+
+
+class STUNServerStatus(object):
+    """
+    Internal object used to save the outcome of the probes sent to a STUN
+    server.
+    """
+    def __init__(self):
+        self.rtt = None
+        self.last_probe = None
+        self.failures = 0
+
+    @property
+    def healthy(self):
+        return self.failures == 0 and self.rtt is not None
+
+
+class STUNProbe(DatagramProtocol):
+    """
+    Internal protocol used to send a STUN Binding Request to a server and to
+    measure the time until the response is received.
+    """
+
+    def __init__(self, address, port, timeout, callback):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.callback = callback
+        self.transaction_id = os.urandom(12)
+        self.start_time = None
+        self.timer = None
+
+    def startProtocol(self):
+        from twisted.internet import reactor
+        self.start_time = time()
+        self.timer = reactor.callLater(self.timeout, self._finish, None)
+        try:
+            self.transport.write(struct.pack('!HHI', 0x0001, 0, 0x2112A442) + self.transaction_id, (self.address, self.port))
+        except Exception:
+            self._finish(None)
+
+    def datagramReceived(self, data, (host, port)):
+        if len(data) >= 20 and struct.unpack('!H', data[:2])[0] == 0x0101 and data[8:20] == self.transaction_id:
+            self._finish(time() - self.start_time)
+
+    def _finish(self, rtt):
+        if self.callback is None:
+            return
+        if self.timer.active():
+            self.timer.cancel()
+        self.transport.stopListening()
+        callback, self.callback = self.callback, None
+        callback(self.address, self.port, rtt)
+
+
+class STUNServerRegistry(object):
+    """
+    Keeps the STUN servers resolved for each domain for cache_ttl seconds and
+    probes them in the background, by sending STUN Binding Requests to all of
+    them in parallel, every probe_interval seconds while the domain is in use.
+    The explicitly configured servers are probed the same way until cache_ttl
+    seconds after they were last used. The servers are returned sorted so that
+    the fastest healthy server comes first, followed by the ones which were
+    not probed yet and then by the ones which failed.
+    """
+
+    __metaclass__ = Singleton
+
+    cache_ttl = 300
+    probe_interval = 60
+    probe_timeout = 2.0
+
+    def __init__(self):
+        self.domains = {}
+        self.servers = {}
+        self.statuses = {}
+        self._lock = RLock()
+        self._probes = set()
+        self._probe_timer = None
+
+    def get_servers(self, domain):
+        """
+        Return the STUN servers cached for domain, sorted by preference, or
+        None if they need to be resolved.
+        """
+        with self._lock:
+            try:
+                expiration, servers = self.domains[domain]
+            except KeyError:
+                return None
+            if expiration <= time():
+                del self.domains[domain]
+                return None
+            return self.sort_servers(servers)
+
+    def add_servers(self, domain, servers):
+        """
+        Cache the STUN servers resolved for domain and start probing them.
+        Returns the servers sorted by preference.
+        """
+        servers = list(servers)
+        with self._lock:
+            self.domains[domain] = (time() + self.cache_ttl, servers)
+        self.probe(servers)
+        return self.sort_servers(servers)
+
+    def use_servers(self, servers):
+        """
+        Record the use of explicitly configured STUN servers, which are kept
+        and probed until cache_ttl seconds after their last use. Returns the
+        servers sorted by preference.
+        """
+        servers = list(servers)
+        with self._lock:
+            expiration = time() + self.cache_ttl
+            for server in servers:
+                self.servers[server] = expiration
+        self.probe(servers)
+        return self.sort_servers(servers)
+
+    def sort_servers(self, servers):
+        with self._lock:
+            # sorting the explicitly configured servers means they are still in use
+            expiration = time() + self.cache_ttl
+            for server in servers:
+                if server in self.servers:
+                    self.servers[server] = expiration
+            def sort_key(item):
+                index, server = item
+                status = self.statuses.get(server)
+                if status is None or status.last_probe is None:
+                    return (1, 0, index)
+                elif status.healthy:
+                    return (0, status.rtt, index)
+                else:
+                    return (2, status.failures, index)
+            return [server for index, server in sorted(enumerate(servers), key=sort_key)]
+
+    def success(self, address, port, rtt=None):
+        with self._lock:
+            status = self.statuses.setdefault((address, port), STUNServerStatus())
+            status.last_probe = time()
+            status.failures = 0
+            if rtt is not None:
+                status.rtt = rtt
+
+    def failure(self, address, port):
+        with self._lock:
+            status = self.statuses.setdefault((address, port), STUNServerStatus())
+            status.last_probe = time()
+            status.failures += 1
+            status.rtt = None
+
+    @staticmethod
+    def is_stun_failure(reason):
+        """
+        Return whether an RTP transport which failed with the specified reason
+        could not gather its candidates because of the STUN server, as opposed
+        to a local problem such as a port which could not be bound.
+        """
+        return reason is not None and ('PJNATH_E' in reason or 'STUN' in reason)
+
+    @run_in_twisted_thread
+    def probe(self, servers):
+        """
+        Send a STUN Binding Request to each of the servers which were not
+        probed in the last probe_interval seconds.
+        """
+        from twisted.internet import reactor
+        now = time()
+        with self._lock:
+            for address, port in servers:
+                status = self.statuses.get((address, port))
+                if (address, port) in self._probes or (status is not None and status.last_probe is not None and now - status.last_probe < self.probe_interval):
+                    continue
+                try:
+                    reactor.listenUDP(0, STUNProbe(address, port, self.probe_timeout, self._probe_finished))
+                except Exception:
+                    self.failure(address, port)
+                else:
+                    self._probes.add((address, port))
+            if self._probe_timer is None and (self.domains or self.servers):
+                self._probe_timer = reactor.callLater(self.probe_interval, self._probe_domains)
+
+    def flush(self, domain=None):
+        with self._lock:
+            if domain is not None:
+                self.domains.pop(domain, None)
+            else:
+                self.domains = {}
+                self.servers = {}
+                self.statuses = {}
+
+    def _probe_finished(self, address, port, rtt):
+        with self._lock:
+            self._probes.discard((address, port))
+            if rtt is not None:
+                self.success(address, port, rtt)
+            else:
+                self.failure(address, port)
+
+    def _probe_domains(self):
+        with self._lock:
+            self._probe_timer = None
+            now = time()
+            for domain, (expiration, servers) in self.domains.items():
+                if expiration <= now:
+                    del self.domains[domain]
+            for server, expiration in self.servers.items():
+                if expiration <= now:
+                    del self.servers[server]
+            servers = set(chain(self.servers, *(servers for expiration, servers in self.domains.itervalues())))
+            for server in set(self.statuses) - servers:
+                del self.statuses[server]
+        self.probe(servers)
+
+
 class DNSResolver(dns.resolver.Resolver):
     """
     The resolver used by DNSLookup.
     
     The lifetime setting on it applies to all the queries made on this resolver.
     Each time a query is performed, its duration is subtracted from the lifetime
-    value.
+    value. The expiration attribute holds the earliest expiration time of the
+    answers obtained through this resolver.
     """
 
     def __init__(self, *args, **kwargs):
         dns.resolver.Resolver.__init__(self, *args, **kwargs)
         self.original_nameservers = self.nameservers
+        self.expiration = positive_infinite
 
     def query(self, qname, *args, **kwargs):
         if not qname.endswith('.'):
@@ -122,9 +427,11 @@ class DNSResolver(dns.resolver.Resolver):
         self.nameservers = self._get_authoritative_ns(qname)
         start_time = time()
         try:
-            return dns.resolver.Resolver.query(self, qname, *args, **kwargs)
+            answer = dns.resolver.Resolver.query(self, qname, *args, **kwargs)
         finally:
             self.lifetime -= min(self.lifetime, time()-start_time)
+        self.expiration = min(self.expiration, answer.expiration)
+        return answer
 
     def _get_authoritative_ns(self, domain):
         self.nameservers = self.original_nameservers
@@ -237,7 +544,9 @@ class DNSLookup(object):
         for a particular SIP URI. As arguments it takes a SIPURI object
         and a list of supported transports, in order of preference of the
         application. It returns a list of Route objects that can be used in
-        order of preference.
+        order of preference. The expiration attribute of the routes indicates
+        the time until which the DNS records they were obtained from are
+        valid.
 
         The DNSLookupDidSucceed notification contains a result attribute which
         is a list of Route objects. The DNSLookupDidFail notification contains
@@ -272,7 +581,7 @@ class DNSLookup(object):
                 if transport not in supported_transports:
                     raise DNSLookupError("Transport %s dictated by URI is not supported" % transport)
                 port = uri.port or (5061 if transport=='tls' else 5060)
-                return [Route(address=uri.host, port=port, transport=transport)]
+                return [Route(address=uri.host, port=port, transport=transport, expiration=resolver.expiration)]
 
             # If the port is specified in the URI, we will only do an A lookup
             elif uri.port:
@@ -281,7 +590,7 @@ class DNSLookup(object):
                     raise DNSLookupError("Transport %s dictated by URI is not supported" % transport)
                 addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
                 if addresses[uri.host]:
-                    return [Route(address=addr, port=uri.port, transport=transport) for addr in addresses[uri.host]]
+                    return [Route(address=addr, port=uri.port, transport=transport, expiration=resolver.expiration) for addr in addresses[uri.host]]
 
             # If the transport was already set as a parameter on the SIP URI, only do SRV lookups
             elif 'transport' in uri.parameters:
@@ -293,13 +602,13 @@ class DNSLookup(object):
                 record_name = '%s.%s' % (transport_service_map[transport], uri.host)
                 services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
                 if services[record_name]:
-                    return [Route(address=result.address, port=result.port, transport=transport) for result in services[record_name]]
+                    return [Route(address=result.address, port=result.port, transport=transport, expiration=resolver.expiration) for result in services[record_name]]
                 else:
                     # If SRV lookup fails, try A lookup
                     addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
                     port = 5061 if transport=='tls' else 5060
                     if addresses[uri.host]:
-                        return [Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]]
+                        return [Route(address=addr, port=port, transport=transport, expiration=resolver.expiration) for addr in addresses[uri.host]]
 
             # Otherwise, it means we don't have a numeric IP address, a port isn't specified and neither is a transport. So we have to do a full NAPTR lookup
             else:
@@ -312,7 +621,7 @@ class DNSLookup(object):
                 naptr_services = [service for service, transport in naptr_service_transport_map.iteritems() if transport in supported_transports]
                 pointers = self._lookup_naptr_record(resolver, uri.host, naptr_services, log_context=log_context)
                 if pointers:
-                    return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service]) for result in pointers]
+                    return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service], expiration=resolver.expiration) for result in pointers]
                 else:
                     # If that fails, try SRV lookup
                     routes = []
@@ -320,7 +629,7 @@ class DNSLookup(object):
                         record_name = '%s.%s' % (transport_service_map[transport], uri.host)
                         services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
                         if services[record_name]:
-                            routes.extend(Route(address=result.address, port=result.port, transport=transport) for result in services[record_name])
+                            routes.extend(Route(address=result.address, port=result.port, transport=transport, expiration=resolver.expiration) for result in services[record_name])
                     if routes:
                         return routes
                     else:
@@ -330,7 +639,7 @@ class DNSLookup(object):
                             addresses = self._lookup_a_records(resolver, [uri.host], log_context=log_context)
                             port = 5061 if transport=='tls' else 5060
                             if addresses[uri.host]:
-                                return [Route(address=addr, port=port, transport=transport) for addr in addresses[uri.host]]
+                                return [Route(address=addr, port=port, transport=transport, expiration=resolver.expiration) for addr in addresses[uri.host]]
         except dns.resolver.Timeout:
             raise DNSLookupError("Timeout in lookup for routes for SIP URI %s" % uri)
         else:
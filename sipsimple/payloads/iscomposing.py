@@ -7,6 +7,9 @@
 __all__ = ['namespace', 'IsComposingApplication', 'State', 'LastActive', 'ContentType', 'Refresh', 'IsComposingMessage']
 
 
+import re
+from xml.sax.saxutils import escape
+
 from sipsimple.payloads import XMLApplication, XMLRootElement, XMLStringElement, XMLElementChild
 from sipsimple.util import Timestamp
 
@@ -80,6 +83,12 @@ class IsComposingMessage(XMLRootElement):
     contenttype = XMLElementChild('contenttype', type=ContentType, required=False, test_equal=True)
     refresh = XMLElementChild('refresh', type=Refresh, required=False, test_equal=True)
     
+    # documents which only contain the elements defined by RFC3994, in the default namespace
+    _simple_document_re = re.compile(r'^\s*(<\?xml\s+version=([\'"])1\.0\2(\s+encoding=([\'"])[uU][tT][fF]-8\4)?\s*\?>)?\s*'
+                                     r'<isComposing\s+xmlns=([\'"])%s\5\s*>\s*((<(state|lastactive|contenttype|refresh)>[^<&]*</\8>\s*)+)</isComposing>\s*$' % re.escape(namespace))
+    _simple_element_re = re.compile(r'<(state|lastactive|contenttype|refresh)>([^<&]*)</\1>')
+    _document_templates = dict((state, '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<isComposing xmlns="%s"><state>%s</state>' % (namespace, state)) for state in ('active', 'idle'))
+
     def __init__(self, state=None, last_active=None, content_type=None, refresh=None):
         XMLRootElement.__init__(self)
         self.state = state
@@ -87,3 +96,47 @@ class IsComposingMessage(XMLRootElement):
         self.contenttype = content_type
         self.refresh = refresh
 
+    @classmethod
+    def generate(cls, state, last_active=None, content_type=None, refresh=None):
+        """
+        Return the document of an isComposing message with the given values
+        without building its element tree, starting from a template for the
+        state.
+        """
+        document = [cls._document_templates[StateValue(state)]]
+        if last_active is not None:
+            document.append('<lastactive>%s</lastactive>' % Timestamp(last_active))
+        if content_type is not None:
+            document.append('<contenttype>%s</contenttype>' % escape(content_type.encode(cls.encoding) if isinstance(content_type, unicode) else content_type))
+        if refresh is not None:
+            document.append('<refresh>%d</refresh>' % RefreshValue(refresh))
+        document.append('</isComposing>')
+        return ''.join(document)
+
+    @classmethod
+    def parse_values(cls, document):
+        """
+        Return the (state, last_active, content_type, refresh) values of an
+        isComposing document, with None for the missing elements. The simple
+        documents are handled with regular expressions and the others, which
+        use namespace prefixes, entities or extension elements, with parse.
+        """
+        match = cls._simple_document_re.match(document)
+        if match is not None:
+            elements = cls._simple_element_re.findall(match.group(6))
+            names = [name for name, value in elements]
+            if names[0] == 'state' and names == [name for name in ('state', 'lastactive', 'contenttype', 'refresh') if name in names]:
+                values = dict(elements)
+                try:
+                    last_active = Timestamp.parse(values['lastactive']) if 'lastactive' in values else None
+                    refresh = RefreshValue(values['refresh']) if 'refresh' in values else None
+                except ValueError:
+                    pass
+                else:
+                    return StateValue(values['state']), last_active, values.get('contenttype'), refresh
+        message = cls.parse(document)
+        return (message.state.value,
+                message.last_active.value if message.last_active is not None else None,
+                message.contenttype.value if message.contenttype is not None else None,
+                message.refresh.value if message.refresh is not None else None)
+
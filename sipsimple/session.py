@@ -10,6 +10,7 @@ Initiation Protocol (SIP) standardized in RFC3261.
 from __future__ import absolute_import, with_statement
 
 from datetime import datetime
+from itertools import count
 from threading import RLock
 
 from application.notification import IObserver, Notification, NotificationCenter
@@ -996,6 +997,10 @@ class Session(object):
             self.end_time = datetime.now()
             notification_center.post_notification('SIPSessionDidEnd', self, TimestampedNotificationData(originator='local', end_reason='user request'))
 
+    @property
+    def call_id(self):
+        return self._invitation.call_id if self._invitation is not None else None
+
     @property
     def local_identity(self):
         if self._invitation is not None and self._invitation.local_identity is not None:
@@ -1401,9 +1406,19 @@ class SessionManager(object):
     implements(IObserver)
 
     def __init__(self):
-        self.sessions = []
         self.state = None
         self._channel = coros.queue()
+        # maps the sessions to their insertion order, in which they are returned
+        self._sessions = {}
+        self._session_counter = count()
+        self._sessions_by_account = {}
+        self._sessions_by_call_id = {}
+        # outgoing sessions don't have a Call-ID until they send the INVITE
+        self._unindexed_sessions = set()
+
+    @property
+    def sessions(self):
+        return sorted(self._sessions, key=self._sessions.get)
 
     def start(self):
         self.state = 'starting'
@@ -1423,7 +1438,7 @@ class SessionManager(object):
         notification_center.post_notification('SIPSessionManagerWillEnd', self, TimestampedNotificationData())
         for session in self.sessions:
             session.end()
-        while self.sessions:
+        while self._sessions:
             self._channel.wait()
         notification_center.remove_observer(self, 'SIPInvitationChangedState')
         notification_center.remove_observer(self, 'SIPSessionNewIncoming')
@@ -1433,6 +1448,29 @@ class SessionManager(object):
         self.state = 'stopped'
         notification_center.post_notification('SIPSessionManagerDidEnd', self, TimestampedNotificationData())
 
+    def get_session_by_call_id(self, call_id):
+        """Return the session with the specified Call-ID or None if there isn't one."""
+        session = self._sessions_by_call_id.get(call_id, None)
+        if session is None and self._unindexed_sessions:
+            for session in [session for session in self._unindexed_sessions if session.call_id is not None]:
+                self._unindexed_sessions.remove(session)
+                self._sessions_by_call_id[session.call_id] = session
+            session = self._sessions_by_call_id.get(call_id, None)
+        return session
+
+    def iter_sessions(self, account=None):
+        """Iterate over the sessions, optionally only over the ones of the specified account."""
+        if account is None:
+            return iter(self.sessions)
+        return iter(sorted(self._sessions_by_account.get(account, ()), key=self._sessions.get))
+
+    def get_state_summary(self):
+        """Return a dictionary with the number of sessions in each state."""
+        summary = {}
+        for session in self._sessions:
+            summary[session.state] = summary.get(session.state, 0) + 1
+        return summary
+
     @run_in_twisted_thread
     def handle_notification(self, notification):
         if notification.name == 'SIPInvitationChangedState' and notification.data.state == 'incoming':
@@ -1445,10 +1483,30 @@ class SessionManager(object):
             session = Session(account)
             session.init_incoming(notification.sender)
         elif notification.name in ('SIPSessionNewIncoming', 'SIPSessionNewOutgoing'):
-            self.sessions.append(notification.sender)
+            self._add_session(notification.sender)
         elif notification.name in ('SIPSessionDidFail', 'SIPSessionDidEnd'):
-            self.sessions.remove(notification.sender)
+            self._remove_session(notification.sender)
             if self.state == 'stopping':
                 self._channel.send(notification)
 
+    def _add_session(self, session):
+        if session not in self._sessions:
+            self._sessions[session] = self._session_counter.next()
+        self._sessions_by_account.setdefault(session.account, set()).add(session)
+        if session.call_id is not None:
+            self._sessions_by_call_id[session.call_id] = session
+        else:
+            self._unindexed_sessions.add(session)
+
+    def _remove_session(self, session):
+        self._sessions.pop(session, None)
+        self._unindexed_sessions.discard(session)
+        account_sessions = self._sessions_by_account.get(session.account)
+        if account_sessions is not None:
+            account_sessions.discard(session)
+            if not account_sessions:
+                del self._sessions_by_account[session.account]
+        if self._sessions_by_call_id.get(session.call_id) is session:
+            del self._sessions_by_call_id[session.call_id]
+
 
@@ -109,15 +109,64 @@ class CPIMIdentity(ChatIdentity):
         return cls(uri, display_name)
 
 
+class LazyHeaderAttribute(object):
+    """
+    Descriptor for a CPIMMessage attribute which is built from header values
+    that are only parsed when the attribute is first accessed. The header
+    values which cannot be parsed are ignored.
+    """
+
+    def __init__(self, name, parser, multiple=False):
+        self.name = name
+        self.parser = parser
+        self.multiple = multiple
+
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            pass
+        values = []
+        for value in obj._raw_headers.pop(self.name, []):
+            try:
+                values.append(self.parser(value))
+            except ValueError:
+                pass
+        if self.multiple:
+            value = values
+        else:
+            value = values[-1] if values else None
+        obj.__dict__[self.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj._raw_headers.pop(self.name, None)
+        obj.__dict__[self.name] = value
+
+
 class CPIMMessage(ChatMessage):
     standard_namespace = u'urn:ietf:params:cpim-headers:'
 
     headers_re = re.compile(r'(?:([^:]+?)\.)?(.+?):\s*(.+?)\r\n')
     subject_re = re.compile(r'^(?:;lang=([a-z]{1,8}(?:-[a-z0-9]{1,8})*)\s+)?(.*)$')
     namespace_re = re.compile(r'^(?:(\S+) ?)?<(.*)>$')
+    mime_header_re = re.compile(r'^([!-9;-~]+):[ \t]*(.*)$')
+    mime_content_type_re = re.compile(r'^([a-z0-9!#$&.+^_-]+/[a-z0-9!#$&.+^_-]+)\s*(?:;\s*charset\s*=\s*"?([a-z0-9!#$&.+^_:-]+)"?\s*)?$', re.IGNORECASE)
+    mime_from_re = re.compile(r'^From ', re.MULTILINE)
+
+    # the headers which are only parsed when the corresponding attribute is accessed
+    lazy_headers = {'From': 'sender', 'To': 'recipients', 'cc': 'courtesy_recipients', 'DateTime': 'timestamp'}
+
+    sender = LazyHeaderAttribute('sender', CPIMIdentity.parse)
+    recipients = LazyHeaderAttribute('recipients', CPIMIdentity.parse, multiple=True)
+    courtesy_recipients = LazyHeaderAttribute('courtesy_recipients', CPIMIdentity.parse, multiple=True)
+    timestamp = LazyHeaderAttribute('timestamp', Timestamp.parse)
 
     def __init__(self, body, content_type, sender=None, recipients=None, courtesy_recipients=None,
                  subject=None, timestamp=None, required=None, additional_headers=None):
+        self._raw_headers = {}
         self.body = body
         self.content_type = content_type
         self.sender = sender
@@ -158,14 +207,68 @@ class CPIMMessage(ChatMessage):
             else:
                 headers.append(u'%s: %s' % (header.name, header.value))
         headers.append(u'')
-        headers = '\r\n'.join(s.encode('cpim-headers') for s in headers)
+        headers = '\r\n'.join(CPIMCodec.encode(s)[0] for s in headers)
+
+        return headers + '\r\n' + self._encode_mime(self.content_type, self.body.encode('utf-8'))
+
+    @classmethod
+    def _encode_mime(cls, content_type, payload):
+        # Generate the same output as the email package for the common case of a
+        # simple content type whose header is not folded, without building a Message
+        content_type_header = 'Content-Type: %s; charset="utf-8"' % content_type
+        if content_type.count('/') != 1 or ';' in content_type or len(content_type_header) > 78:
+            return cls._encode_mime_message(content_type, payload)
+        if 'From ' in payload:
+            payload = cls.mime_from_re.sub('>From ', payload)
+        return 'MIME-Version: 1.0\n' + content_type_header + '\n\n' + payload
 
+    @classmethod
+    def _encode_mime_message(cls, content_type, payload):
         message = Message()
-        message.set_type(self.content_type)
+        message.set_type(content_type)
         message.set_param('charset', 'utf-8')
-        message.set_payload(self.body.encode('utf-8'))
+        message.set_payload(payload)
+        return message.as_string()
 
-        return headers + '\r\n' + message.as_string()
+    @classmethod
+    def _decode_mime(cls, string):
+        # Parse the common case of a single part message with simple headers
+        # without the email package, giving the same results
+        crlf_headers_end = string.find('\r\n\r\n')
+        lf_headers_end = string.find('\n\n')
+        if crlf_headers_end != -1 and (lf_headers_end == -1 or crlf_headers_end < lf_headers_end):
+            headers_end, line_end = crlf_headers_end, '\r\n'
+        elif lf_headers_end != -1:
+            headers_end, line_end = lf_headers_end, '\n'
+        else:
+            return cls._decode_mime_message(string)
+        content_type = None
+        charset = None
+        for line in string[:headers_end].split(line_end):
+            match = cls.mime_header_re.match(line)
+            if match is None or '\n' in line or '\r' in line:
+                return cls._decode_mime_message(string)
+            name, value = match.groups()
+            if name.lower() == 'content-type' and content_type is None:
+                match = cls.mime_content_type_re.match(value)
+                if match is None:
+                    return cls._decode_mime_message(string)
+                content_type, charset = match.groups()
+        content_type = content_type.lower() if content_type is not None else 'text/plain'
+        if content_type.startswith('multipart/') or content_type == 'message/rfc822':
+            return cls._decode_mime_message(string)
+        charset = charset.lower() if charset is not None else 'utf-8'
+        return content_type, string[headers_end+2*len(line_end):].decode(charset)
+
+    @classmethod
+    def _decode_mime_message(cls, string):
+        mime_message = Parser().parsestr(string)
+        content_type = mime_message.get_content_type()
+        if content_type.startswith('multipart/') or content_type == 'message/rfc822':
+            body = mime_message.get_payload()
+        else:
+            body = mime_message.get_payload().decode(mime_message.get_content_charset() or 'utf-8')
+        return content_type, body
 
     @classmethod
     def parse(cls, string):
@@ -177,10 +280,11 @@ class CPIMMessage(ChatMessage):
             raise CPIMParserError('Invalid CPIM message')
         else:
             headers = cls.headers_re.findall(buffer(string, 0, headers_end+2))
-            body = buffer(string, headers_end+4)
+            body = string[headers_end+4:]
 
         namespaces = {u'': Namespace(cls.standard_namespace, u'')}
         subjects = {}
+        raw_headers = {}
         for prefix, name, value in headers:
             if '.' in name:
                 continue
@@ -188,13 +292,10 @@ class CPIMMessage(ChatMessage):
             if not namespace:
                 continue
             try:
-                value = value.decode('cpim-headers')
-                if name == 'From' and namespace == cls.standard_namespace:
-                    message.sender = CPIMIdentity.parse(value)
-                elif name == 'To' and namespace == cls.standard_namespace:
-                    message.recipients.append(CPIMIdentity.parse(value))
-                elif name == 'cc' and namespace == cls.standard_namespace:
-                    message.courtesy_recipients.append(CPIMIdentity.parse(value))
+                # the escapes are rare, so the full header decoding is only done when needed
+                value = value.decode('utf-8') if '\\' not in value else CPIMCodec.decode(value)[0]
+                if name in cls.lazy_headers and namespace == cls.standard_namespace:
+                    raw_headers.setdefault(cls.lazy_headers[name], []).append(value)
                 elif name == 'Subject' and namespace == cls.standard_namespace:
                     match = cls.subject_re.match(value)
                     if match is None:
@@ -202,8 +303,6 @@ class CPIMMessage(ChatMessage):
                     lang, subject = match.groups()
                     # language tags must be ASCII
                     subjects[str(lang) if lang is not None else None] = subject
-                elif name == 'DateTime' and namespace == cls.standard_namespace:
-                    message.timestamp = Timestamp.parse(value)
                 elif name == 'Required' and namespace == cls.standard_namespace:
                     message.required.extend(re.split(r'\s*,\s*', value))
                 elif name == 'NS' and namespace == cls.standard_namespace:
@@ -221,12 +320,10 @@ class CPIMMessage(ChatMessage):
             message.subject = MultilingualText(subjects.pop(None), **subjects)
         else:
             message.subject = MultilingualText(**subjects)
-        mime_message = Parser().parsestr(body)
-        message.content_type = mime_message.get_content_type()
-        if message.content_type.startswith('multipart/') or message.content_type == 'message/rfc822':
-            message.body = mime_message.get_payload()
-        else:
-            message.body = mime_message.get_payload().decode(mime_message.get_content_charset() or 'utf-8')
+        for name in raw_headers:
+            del message.__dict__[name]
+        message._raw_headers = raw_headers
+        message.content_type, message.body = cls._decode_mime(body)
         if message.content_type is None:
             raise CPIMParserError("CPIM message missing Content-Type MIME header")
 
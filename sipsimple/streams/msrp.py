@@ -10,25 +10,35 @@ sessions that negotiate Instant Messsaging, File Transfer and Desktop
 Sharing and handling of the actual media streams.
 """
 
-__all__ = ['MSRPStreamError', 'ChatStreamError', 'ChatStream', 'FileSelector', 'FileTransferStream', 'IDesktopSharingHandler', 'DesktopSharingHandlerBase',
-           'InternalVNCViewerHandler', 'InternalVNCServerHandler', 'ExternalVNCViewerHandler', 'ExternalVNCServerHandler', 'DesktopSharingStream']
+from __future__ import with_statement
+
+__all__ = ['MSRPStreamError', 'ChatStreamError', 'MSRPRelayPool', 'ChatStream', 'FileHashCache', 'FileSelector', 'ByteRangeSet', 'FileTransferStream', 'IDesktopSharingHandler', 'DesktopSharingHandlerBase',
+           'BoundedQueue', 'InternalVNCViewerHandler', 'InternalVNCServerHandler', 'ExternalVNCViewerHandler', 'ExternalVNCServerHandler', 'DesktopSharingStream']
 
 import os
 import re
 import random
 import hashlib
 import mimetypes
+import time
+import weakref
+from collections import deque
 from datetime import datetime
+from Queue import Queue
+from threading import RLock, Thread
 
 from application.notification import NotificationCenter, NotificationData, IObserver
+from application.python.util import Singleton
 from application.system import host
 from functools import partial
+from twisted.internet import reactor
 from twisted.internet.error import ConnectionDone
+from twisted.internet.threads import deferToThread
 from twisted.python.failure import Failure
 from zope.interface import implements, Interface, Attribute
 
 from eventlet import api
-from eventlet.coros import queue
+from eventlet.coros import event, queue
 from eventlet.greenio import GreenSocket
 from eventlet.proc import spawn, ProcExit
 from eventlet.util import tcp_socket, set_reuse_addr
@@ -38,8 +48,9 @@ from msrplib.session import MSRPSession, contains_mime_type, OutgoingFile
 from msrplib.transport import make_response, make_report
 
 from sipsimple.account import Account
+from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import SDPAttribute, SDPMediaStream
-from sipsimple.payloads.iscomposing import IsComposingMessage, State, LastActive, Refresh, ContentType
+from sipsimple.payloads.iscomposing import IsComposingMessage
 from sipsimple.streams import IMediaStream, MediaStreamRegistrar, StreamError, InvalidStreamError, UnknownStreamError
 from sipsimple.streams.applications.chat import ChatIdentity, ChatMessage, CPIMMessage, CPIMParserError
 from sipsimple.util import run_in_green_thread, run_in_twisted_thread, TimestampedNotificationData
@@ -49,6 +60,191 @@ class MSRPStreamError(StreamError): pass
 class ChatStreamError(MSRPStreamError): pass
 
 
+class MSRPRelayPool(object):
+    """
+    A pool of MSRP connectors for an account which are already connected and
+    authenticated to its MSRP relay, which allows the MSRP streams to skip
+    the connection setup and the AUTH transactions with the relay when they
+    are initialized. For each combination of relay settings and direction
+    which was requested, the pool is refilled in the background up to
+    account.msrp.relay_pool_size connectors. Connectors which are older than
+    max_age seconds are replaced, as the relay may drop idle connections, and
+    the ones for the settings which were not requested for idle_timeout
+    seconds are closed. A pool size of 0 disables the pool.
+    """
+
+    implements(IObserver)
+
+    max_age = 60
+    idle_timeout = 600
+
+    _pools = weakref.WeakKeyDictionary()
+
+    def __init__(self, account):
+        self._account = weakref.ref(account, self._account_died)
+        self._lock = RLock()
+        self._connectors = {}
+        self._requests = {}
+        self._pending = {}
+        self._generation = 0
+        self._refresh_timer = None
+        self.hits = 0
+        self.misses = 0
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SystemIPAddressDidChange')
+        notification_center.add_observer(self, name='SIPApplicationWillEnd')
+
+    @classmethod
+    def for_account(cls, account):
+        try:
+            return cls._pools[account]
+        except KeyError:
+            return cls._pools.setdefault(account, cls(account))
+
+    @property
+    def size(self):
+        account = self._account()
+        return account.msrp.relay_pool_size if account is not None else 0
+
+    @property
+    def statistics(self):
+        with self._lock:
+            return dict(available=sum(len(connectors) for connectors in self._connectors.itervalues()), pending=sum(self._pending.itervalues()), hits=self.hits, misses=self.misses)
+
+    def get(self, relay, outgoing):
+        """
+        Return a (connector, full_local_path) tuple with a connector which was
+        prepared for the specified relay settings and direction or None if the
+        pool doesn't have one available.
+        """
+        if self.size == 0:
+            return None
+        parameters = (outgoing, relay.domain, relay.username, relay.password, relay.host, relay.port, relay.use_tls)
+        stale = []
+        with self._lock:
+            self._requests[parameters] = (relay, time.time())
+            connectors = self._connectors.setdefault(parameters, deque())
+            expiration = time.time() - self.max_age
+            result = None
+            while connectors:
+                timestamp, connector, full_local_path = connectors.pop()
+                if timestamp > expiration:
+                    result = connector, full_local_path
+                    break
+                stale.append(connector)
+            if result is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        for connector in stale:
+            self._cleanup(connector)
+        self._refill()
+        return result
+
+    def flush(self):
+        with self._lock:
+            stale = [connector for connectors in self._connectors.itervalues() for timestamp, connector, full_local_path in connectors]
+            self._connectors = dict((parameters, deque()) for parameters in self._connectors)
+            self._generation += 1
+        for connector in stale:
+            self._cleanup(connector)
+        self._refill()
+
+    @run_in_twisted_thread
+    def _refill(self):
+        account = self._account()
+        stale = []
+        with self._lock:
+            size = self.size
+            if account is None or size == 0:
+                stale.extend(connector for connectors in self._connectors.itervalues() for timestamp, connector, full_local_path in connectors)
+                self._connectors = {}
+                self._requests = {}
+            else:
+                now = time.time()
+                for parameters, (relay, last_request) in self._requests.items():
+                    connectors = self._connectors.setdefault(parameters, deque())
+                    if last_request <= now - self.idle_timeout:
+                        stale.extend(connector for timestamp, connector, full_local_path in connectors)
+                        del self._connectors[parameters]
+                        del self._requests[parameters]
+                        continue
+                    while connectors and connectors[0][0] <= now - self.max_age:
+                        stale.append(connectors.popleft()[1])
+                    missing = size - len(connectors) - self._pending.get(parameters, 0)
+                    for i in xrange(missing):
+                        self._pending[parameters] = self._pending.get(parameters, 0) + 1
+                        self._prepare(account, parameters, relay, self._generation)
+            if self._refresh_timer is None and self._requests:
+                self._refresh_timer = reactor.callLater(self.max_age/2, self._refresh)
+        for connector in stale:
+            self._cleanup(connector)
+
+    def _refresh(self):
+        self._refresh_timer = None
+        self._refill()
+
+    def _account_died(self, account_ref):
+        # the notification center keeps the pool alive, so it must release itself along with its connectors
+        reactor.callFromThread(self._discard)
+
+    def _discard(self):
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='SystemIPAddressDidChange')
+        notification_center.remove_observer(self, name='SIPApplicationWillEnd')
+        with self._lock:
+            if self._refresh_timer is not None and self._refresh_timer.active():
+                self._refresh_timer.cancel()
+            self._refresh_timer = None
+            stale = [connector for connectors in self._connectors.itervalues() for timestamp, connector, full_local_path in connectors]
+            self._connectors = {}
+            self._requests = {}
+            self._generation += 1
+        for connector in stale:
+            self._cleanup(connector)
+
+    @run_in_green_thread
+    def _prepare(self, account, parameters, relay, generation):
+        outgoing = parameters[0]
+        logger = NotificationProxyLogger()
+        local_uri = URI(host=host.default_ip, port=0, use_tls=relay.use_tls, credentials=account.tls_credentials)
+        connector = get_connector(relay=relay, logger=logger) if outgoing else get_acceptor(relay=relay, logger=logger)
+        try:
+            full_local_path = connector.prepare(local_uri)
+        except Exception:
+            full_local_path = None
+        with self._lock:
+            self._pending[parameters] -= 1
+            if not self._pending[parameters]:
+                del self._pending[parameters]
+            connectors = self._connectors.get(parameters)
+            if full_local_path is not None and connectors is not None and generation == self._generation and len(connectors) < self.size:
+                connectors.append((time.time(), connector, full_local_path))
+                connector = None
+        if connector is not None:
+            self._cleanup(connector)
+
+    @run_in_green_thread
+    def _cleanup(self, connector):
+        try:
+            connector.cleanup()
+        except Exception:
+            pass
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, None)
+        if handler is not None:
+            handler(notification)
+
+    def _NH_SystemIPAddressDidChange(self, notification):
+        self.flush()
+
+    def _NH_SIPApplicationWillEnd(self, notification):
+        with self._lock:
+            self._requests = {}
+        self.flush()
+
+
 class MSRPStreamBase(object):
     __metaclass__ = MediaStreamRegistrar
 
@@ -142,6 +338,7 @@ class MSRPStreamBase(object):
             if not outgoing and relay is None and self.transport == 'tls' and None in (self.account.tls_credentials.cert, self.account.tls_credentials.key):
                 raise MSRPStreamError("cannot create incoming MSRP stream without a certificate and private key")
             logger = NotificationProxyLogger()
+            full_local_path = None
             local_uri = URI(host=host.default_ip,
                             port=0,
                             use_tls=self.transport=='tls',
@@ -169,9 +366,14 @@ class MSRPStreamBase(object):
                         self.msrp_connector = get_acceptor(relay=None, use_acm=True, logger=logger)
                         self.local_role = 'passive'
             else:
-                self.msrp_connector = get_connector(relay=relay, logger=logger) if outgoing else get_acceptor(relay=relay, logger=logger)
+                pooled_connector = MSRPRelayPool.for_account(self.account).get(relay, outgoing) if relay is not None else None
+                if pooled_connector is not None:
+                    self.msrp_connector, full_local_path = pooled_connector
+                else:
+                    self.msrp_connector = get_connector(relay=relay, logger=logger) if outgoing else get_acceptor(relay=relay, logger=logger)
                 self.local_role = 'active' if outgoing else 'passive'
-            full_local_path = self.msrp_connector.prepare(local_uri)
+            if full_local_path is None:
+                full_local_path = self.msrp_connector.prepare(local_uri)
             self.local_media = self._create_local_media(full_local_path)
         except api.GreenletExit:
             raise
@@ -305,6 +507,11 @@ class ChatStream(MSRPStreamBase):
         MSRPStreamBase.__init__(self, account, direction)
         self.message_queue = queue()
         self.sent_messages = set()
+        self._pending_messages = []
+        self._pending_lock = RLock()
+        self._outstanding_transactions = set()
+        self._window_event = None
+        self._composing_indications = {}
 
     @classmethod
     def new_from_sdp(cls, account, remote_sdp, stream_index):
@@ -331,6 +538,8 @@ class ChatStream(MSRPStreamBase):
 
     def _NH_MediaStreamDidEnd(self, notification):
         self.message_queue.send_exception(ProcExit)
+        if self._window_event is not None and not self._window_event.ready():
+            self._window_event.send_exception(ProcExit)
 
     def _handle_REPORT(self, chunk):
         # in theory, REPORT can come with Byte-Range which would limit the scope of the REPORT to the part of the message.
@@ -363,17 +572,24 @@ class ChatStream(MSRPStreamBase):
         # TODO: check wrapped content-type and issue a report/responsd with negative code if it's invalid
         notification_center = NotificationCenter()
         if message.content_type.lower() == IsComposingMessage.content_type:
-            data = IsComposingMessage.parse(message.body)
-            ndata = TimestampedNotificationData(state=data.state.value,
-                                                refresh=data.refresh.value if data.refresh is not None else None,
-                                                content_type=data.contenttype.value if data.contenttype is not None else None,
-                                                last_active=data.last_active.value if data.last_active is not None else None,
-                                                sender=message.sender)
+            state, last_active, content_type, refresh = IsComposingMessage.parse_values(message.body)
+            # a sender repeats the active state before the refresh interval expires, the repetitions
+            # are only posted when half of the interval (120 seconds by default) has passed
+            sender = str(message.sender.uri) if message.sender is not None else None
+            previous = self._composing_indications.get(sender)
+            now = time.time()
+            if previous is not None and previous[:3] == (state, content_type, refresh) and (state == 'idle' or now - previous[3] < (refresh or 120)/2.0):
+                return
+            self._composing_indications[sender] = (state, content_type, refresh, now)
+            ndata = TimestampedNotificationData(state=state, refresh=refresh, content_type=content_type, last_active=last_active, sender=message.sender)
             notification_center.post_notification('ChatStreamGotComposingIndication', self, ndata)
         else:
             notification_center.post_notification('ChatStreamGotMessage', self, TimestampedNotificationData(message=message))
 
     def _on_transaction_response(self, message_id, response):
+        self._outstanding_transactions.discard(message_id)
+        if self._window_event is not None and not self._window_event.ready():
+            self._window_event.send()
         if message_id in self.sent_messages and response.code != 200:
             self.sent_messages.remove(message_id)
             data = TimestampedNotificationData(message_id=message_id, message=response, code=response.code, reason=response.comment)
@@ -381,30 +597,54 @@ class ChatStream(MSRPStreamBase):
 
     def _message_queue_handler(self):
         notification_center = NotificationCenter()
+        settings = SIPSimpleSettings()
         while True:
-            message_id, message, content_type, failure_report, success_report, notify_progress = self.message_queue.wait()
-            if self.msrp_session is None:
-                # should we generate ChatStreamDidNotDeliver per each message in the queue here?
-                break
-            chunk = self.msrp_session.make_message(message, content_type=content_type, message_id=message_id)
-            if failure_report is not None:
-                chunk.add_header(FailureReportHeader(failure_report))
-            if success_report is not None:
-                chunk.add_header(SuccessReportHeader(success_report))
-            try:
-                self.msrp_session.send_chunk(chunk, response_cb=partial(self._on_transaction_response, message_id))
-            except Exception, e:
-                ndata = TimestampedNotificationData(context='sending', failure=Failure(), reason=str(e))
-                notification_center.post_notification('MediaStreamDidFail', self, ndata)
-                break
-            else:
-                if notify_progress and success_report == 'yes' and failure_report != 'no':
-                    self.sent_messages.add(message_id)
-                    notification_center.post_notification('ChatStreamDidSendMessage', self, TimestampedNotificationData(message=chunk))
+            # take all the messages which are queued at once
+            messages = self.message_queue.wait()
+            while self.message_queue.ready():
+                messages.extend(self.message_queue.wait())
+            for message_id, message, content_type, failure_report, success_report, notify_progress in messages:
+                if self.msrp_session is None:
+                    # should we generate ChatStreamDidNotDeliver per each message in the queue here?
+                    return
+                # only the transactions for which a response is expected count against the window
+                window = settings.chat.max_outstanding_transactions
+                while window and len(self._outstanding_transactions) >= window:
+                    self._window_event = event()
+                    self._window_event.wait()
+                    self._window_event = None
+                chunk = self.msrp_session.make_message(message, content_type=content_type, message_id=message_id)
+                if failure_report is not None:
+                    chunk.add_header(FailureReportHeader(failure_report))
+                if success_report is not None:
+                    chunk.add_header(SuccessReportHeader(success_report))
+                try:
+                    self.msrp_session.send_chunk(chunk, response_cb=partial(self._on_transaction_response, message_id))
+                except Exception, e:
+                    ndata = TimestampedNotificationData(context='sending', failure=Failure(), reason=str(e))
+                    notification_center.post_notification('MediaStreamDidFail', self, ndata)
+                    return
+                else:
+                    if failure_report in (None, 'yes'):
+                        self._outstanding_transactions.add(message_id)
+                    if notify_progress and success_report == 'yes' and failure_report != 'no':
+                        self.sent_messages.add(message_id)
+                        notification_center.post_notification('ChatStreamDidSendMessage', self, TimestampedNotificationData(message=chunk))
 
-    @run_in_twisted_thread
     def _enqueue_message(self, message_id, message, content_type, failure_report=None, success_report=None, notify_progress=True):
-        self.message_queue.send((message_id, message, content_type, failure_report, success_report, notify_progress))
+        # the messages are collected and handed over to the twisted thread in batches, only
+        # the first message enqueued after a batch was handed over schedules the next one
+        with self._pending_lock:
+            self._pending_messages.append((message_id, message, content_type, failure_report, success_report, notify_progress))
+            if len(self._pending_messages) > 1:
+                return
+        self._send_pending_messages()
+
+    @run_in_twisted_thread
+    def _send_pending_messages(self):
+        with self._pending_lock:
+            messages, self._pending_messages = self._pending_messages, []
+        self.message_queue.send(messages)
 
     def send_message(self, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None):
         """Send IM message. Prefer Message/CPIM wrapper if it is supported.
@@ -456,7 +696,7 @@ class ChatStream(MSRPStreamBase):
         if state not in ('active', 'idle'):
             raise ValueError('Invalid value for composing indication state')
         message_id = '%x' % random.getrandbits(64)
-        content = IsComposingMessage(state=State(state), refresh=Refresh(refresh), last_active=LastActive(last_active or datetime.now()), content_type=ContentType('text')).toxml()
+        content = IsComposingMessage.generate(state, last_active=last_active or datetime.now(), content_type='text', refresh=refresh)
         if self.cpim_enabled:
             if recipients is None:
                 recipients = [self.remote_identity]
@@ -474,6 +714,39 @@ class ChatStream(MSRPStreamBase):
 # File transfer
 #
 
+class FileHashCache(object):
+    """
+    A cache of the hashes of the files which were sent, indexed by path and
+    validated using the size and modification time of the file, so that the
+    same file does not have to be read again when it is sent again.
+    """
+
+    __metaclass__ = Singleton
+
+    max_entries = 1000
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = RLock()
+
+    def get(self, path, stat):
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+            return entry[2]
+        return None
+
+    def add(self, path, stat, hash):
+        with self._lock:
+            if path not in self._entries and len(self._entries) >= self.max_entries:
+                self._entries.pop(iter(self._entries).next())
+            self._entries[path] = (stat.st_size, stat.st_mtime, hash)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 class FileSelector(object):
     class __metaclass__(type):
         _name_re = re.compile('name:"([^"]+)"')
@@ -504,10 +777,18 @@ class FileSelector(object):
         return cls(name, type, size, hash)
 
     @classmethod
-    def for_file(cls, path, content_type=None, compute_hash=True):
+    def for_file(cls, path, content_type=None, compute_hash=True, use_cache=True):
+        """
+        Create a FileSelector for the specified file, computing the hash of
+        its content if compute_hash is True. When use_cache is True, the hash
+        is taken from the FileHashCache if the file did not change since it
+        was last computed. This reads the whole file, so for large files
+        for_file_async should be used instead.
+        """
         fd = open(path, 'r')
         name = os.path.basename(path)
-        size = os.fstat(fd.fileno()).st_size
+        stat = os.fstat(fd.fileno())
+        size = stat.st_size
         if content_type is None:
             mime_type, encoding = mimetypes.guess_type(name)
             if encoding is not None:
@@ -519,26 +800,246 @@ class FileSelector(object):
         else:
             type = content_type
         if compute_hash:
-            sha1 = hashlib.sha1()
-            while True:
-                content = fd.read(65536)
-                if not content:
-                    break
-                sha1.update(content)
-            # unexpected as it may be, using a regular expression is the fastest method to do this
-            hash = 'sha1:' + ':'.join(cls._byte_re.findall(sha1.hexdigest().upper()))
-            fd.seek(0)
+            hash_cache = FileHashCache()
+            real_path = os.path.realpath(path)
+            hash = hash_cache.get(real_path, stat) if use_cache else None
+            if hash is None:
+                sha1 = hashlib.sha1()
+                while True:
+                    content = fd.read(1048576)
+                    if not content:
+                        break
+                    sha1.update(content)
+                hash = cls.format_hash(sha1)
+                fd.seek(0)
+                hash_cache.add(real_path, stat, hash)
         else:
             hash = None
         return cls(name, type, size, hash, fd)
 
+    @classmethod
+    def for_file_async(cls, path, content_type=None, compute_hash=True, use_cache=True):
+        """
+        Same as for_file, except that the file is read and hashed in a worker
+        thread. Returns a Deferred which fires with the FileSelector; from a
+        green thread it can be waited for using eventlet.twistedutil.block_on.
+        """
+        return deferToThread(cls.for_file, path, content_type, compute_hash, use_cache)
+
+    @classmethod
+    def format_hash(cls, sha1):
+        # unexpected as it may be, using a regular expression is the fastest method to do this
+        return 'sha1:' + ':'.join(cls._byte_re.findall(sha1.hexdigest().upper()))
+
     @property
     def sdp_repr(self):
         items = [('name', self.name and '"%s"' % self.name), ('type', self.type), ('size', self.size), ('hash', self.hash)]
         return ' '.join('%s:%s' % (name, value) for name, value in items if value is not None)
 
 
+class ByteRangeSet(object):
+    """
+    A set of byte ranges of a file, kept as a sorted list of disjoint
+    (start, end) tuples, with start inclusive and end exclusive and both
+    starting from 0, as opposed to the MSRP Byte-Range header.
+    """
+
+    def __init__(self, ranges=()):
+        self.ranges = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.ranges)
+
+    def __len__(self):
+        return sum(end-start for start, end in self.ranges)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        ranges = self.ranges
+        if not ranges or ranges[-1][1] < start:
+            ranges.append((start, end))
+        elif ranges[-1][0] <= start and ranges[-1][1] >= start:
+            # the common case, when the data arrives in order
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            new_ranges = []
+            for range_start, range_end in ranges:
+                if range_end < start:
+                    new_ranges.append((range_start, range_end))
+                elif range_start > end:
+                    if start is not None:
+                        new_ranges.append((start, end))
+                        start = None
+                    new_ranges.append((range_start, range_end))
+                else:
+                    start, end = min(start, range_start), max(end, range_end)
+            if start is not None:
+                new_ranges.append((start, end))
+            self.ranges = new_ranges
+
+    def covers(self, start, end):
+        return any(range_start <= start and range_end >= end for range_start, range_end in self.ranges)
+
+    @property
+    def prefix_length(self):
+        """The number of bytes available from the beginning of the file without any gaps"""
+        return self.ranges[0][1] if self.ranges and self.ranges[0][0] == 0 else 0
+
+
+class FileWriter(object):
+    """
+    Writes the data received by a FileTransferStream to a file from a separate
+    thread, at the offsets given by the Byte-Range of the chunks, and computes
+    the hash of the file as the data is written. The stream only hands over the
+    chunks, so the file I/O and the hashing are kept out of the reactor thread.
+    When max_pending chunks are waiting to be written, the green thread which
+    hands over the chunks is paused until the writer catches up, which stops
+    reading from the MSRP transport without blocking the reactor thread. Once
+    the writer thread has exited, the data which is handed over is ignored.
+
+    While writing, a FileTransferStreamDidWriteData notification is posted on
+    behalf of the stream at most every progress_interval seconds. When the
+    whole file was written, its hash is checked against the one in the file
+    selector and either FileTransferStreamDidFinish or MediaStreamDidFail is
+    posted.
+    """
+
+    max_pending = 256
+    progress_interval = 1.0
+
+    def __init__(self, stream, sink, offset=0):
+        self.stream = stream
+        self.file_size = stream.file_selector.size
+        self.file_hash = stream.file_selector.hash
+        if isinstance(sink, basestring):
+            self.file = open(sink, 'r+b' if offset else 'w+b')
+            self._close_file = True
+        else:
+            self.file = sink
+            self._close_file = False
+        self.offset = offset
+        self.transferred_bytes = offset
+        self._sha1 = hashlib.sha1()
+        self._hash_position = 0
+        self._last_progress = 0
+        self._queue = Queue()
+        self._space_event = None
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='FileWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def write(self, offset, data, transferred_bytes):
+        if self._stopped:
+            return
+        self._queue.put(('write', offset, data, transferred_bytes))
+        if api.getcurrent() is api.get_hub().greenlet:
+            return
+        while not self._stopped and self._queue.qsize() >= self.max_pending:
+            # the event is set before checking the queue size again, so that the writer thread
+            # signals it after taking out any of the chunks which are still pending
+            self._space_event = event()
+            if not self._stopped and self._queue.qsize() >= self.max_pending:
+                self._space_event.wait()
+            self._space_event = None
+
+    def finish(self):
+        if not self._stopped:
+            self._queue.put(('finish', None, None, None))
+
+    def stop(self):
+        if not self._stopped:
+            self._queue.put(('stop', None, None, None))
+
+    def _signal_space(self):
+        space_event = self._space_event
+        if space_event is not None:
+            reactor.callFromThread(self._send_space_event, space_event)
+
+    @staticmethod
+    def _send_space_event(space_event):
+        if not space_event.ready():
+            space_event.send()
+
+    def _run(self):
+        notification_center = NotificationCenter()
+        try:
+            if self.offset:
+                # resuming, the part of the file which is already there is hashed first
+                self.file.seek(0)
+                while self._hash_position < self.offset:
+                    content = self.file.read(min(1048576, self.offset-self._hash_position))
+                    if not content:
+                        break
+                    self._sha1.update(content)
+                    self._hash_position += len(content)
+            while True:
+                command, offset, data, transferred_bytes = self._queue.get()
+                self._signal_space()
+                if command == 'write':
+                    if self.file.tell() != offset:
+                        self.file.seek(offset)
+                    self.file.write(data)
+                    self.transferred_bytes = transferred_bytes
+                    # the hash can only be computed incrementally while the data arrives in order
+                    if self._hash_position == offset:
+                        self._sha1.update(data)
+                        self._hash_position += len(data)
+                    now = time.time()
+                    if now - self._last_progress >= self.progress_interval:
+                        self._last_progress = now
+                        notification_center.post_notification('FileTransferStreamDidWriteData', self.stream, TimestampedNotificationData(transferred_bytes=self.transferred_bytes, file_size=self.file_size))
+                elif command == 'finish':
+                    self.file.flush()
+                    notification_center.post_notification('FileTransferStreamDidWriteData', self.stream, TimestampedNotificationData(transferred_bytes=self.transferred_bytes, file_size=self.file_size))
+                    if self.file_hash is not None and FileSelector.format_hash(self._compute_hash()) != self.file_hash:
+                        e = MSRPStreamError("File hash does not match")
+                        notification_center.post_notification('MediaStreamDidFail', self.stream, TimestampedNotificationData(context='writing', failure=Failure(e), reason=str(e)))
+                    else:
+                        notification_center.post_notification('FileTransferStreamDidFinish', self.stream, TimestampedNotificationData())
+                    break
+                else:
+                    break
+        except EnvironmentError, e:
+            notification_center.post_notification('MediaStreamDidFail', self.stream, TimestampedNotificationData(context='writing', failure=Failure(), reason=str(e)))
+        finally:
+            self._stopped = True
+            self._signal_space()
+            if self._close_file:
+                self.file.close()
+            self.stream = None
+
+    def _compute_hash(self):
+        if self._hash_position < self.file_size:
+            # some data arrived out of order, read the rest of the file to finish the hash
+            self.file.seek(self._hash_position)
+            while True:
+                content = self.file.read(65536)
+                if not content:
+                    break
+                self._sha1.update(content)
+                self._hash_position += len(content)
+        return self._sha1
+
+
 class FileTransferStream(MSRPStreamBase):
+    """
+    A file transfer stream. For incoming files, the received chunks are posted
+    in FileTransferStreamGotChunk notifications, unless a sink is given, in
+    which case they are written directly to it by a FileWriter. The sink can
+    be a path or a file object open for writing and reading and it can also be
+    set as an attribute after the stream was created by new_from_sdp.
+
+    If resume is True and the sink already contains the beginning of the file
+    from an earlier attempt, the receiver asks for the rest of the file only,
+    using a file-range attribute in its SDP, and the sender starts sending
+    from the offset given by the file-range attribute of the remote SDP. The
+    data which was received or delivered is tracked as a ByteRangeSet, so it
+    does not matter in which order the chunks arrive.
+    """
 
     type = 'file-transfer'
     priority = 10
@@ -548,9 +1049,14 @@ class FileTransferStream(MSRPStreamBase):
     accept_types = ['*']
     accept_wrapped_types = ['*']
 
-    def __init__(self, account, file_selector=None):
+    def __init__(self, account, file_selector=None, sink=None, resume=False):
         MSRPStreamBase.__init__(self, account, direction='sendonly' if file_selector is not None else 'recvonly')
         self.file_selector = file_selector
+        self.sink = sink
+        self.resume = resume
+        self.file_writer = None
+        self.transferred_ranges = ByteRangeSet()
+        self._offset = 0
         if file_selector is not None:
             self.outgoing_file = OutgoingFile(file_selector.fd, file_selector.size, content_type=file_selector.type)
             self.outgoing_file.headers['Success-Report'] = SuccessReportHeader('yes')
@@ -574,20 +1080,61 @@ class FileTransferStream(MSRPStreamBase):
     def _create_local_media(self, uri_path):
         local_media = MSRPStreamBase._create_local_media(self, uri_path)
         local_media.attributes.append(SDPAttribute('file-selector', self.file_selector.sdp_repr))
+        if self.direction == 'recvonly' and self.resume:
+            self._offset = self._get_existing_size()
+            if self._offset:
+                local_media.attributes.append(SDPAttribute('file-range', '%d-%d' % (self._offset+1, self.file_selector.size)))
         return local_media
 
+    def _get_existing_size(self):
+        if self.sink is None or self.file_selector.size is None:
+            return 0
+        try:
+            if isinstance(self.sink, basestring):
+                size = os.path.getsize(self.sink)
+            else:
+                size = os.fstat(self.sink.fileno()).st_size
+        except EnvironmentError:
+            return 0
+        return size if size < self.file_selector.size else 0
+
+    def start(self, local_sdp, remote_sdp, stream_index):
+        if self.direction == 'sendonly':
+            file_range = remote_sdp.media[stream_index].attributes.getfirst('file-range')
+            if file_range is not None:
+                try:
+                    self._offset = max(int(file_range.split('-')[0]) - 1, 0)
+                except ValueError:
+                    self._offset = 0
+                if self._offset >= self.file_selector.size:
+                    self._offset = 0
+        MSRPStreamBase.start(self, local_sdp, remote_sdp, stream_index)
+
     def _NH_MediaStreamDidStart(self, notification):
+        self.transferred_ranges.add(0, self._offset)
         if self.direction == 'sendonly':
+            if self._offset:
+                self.file_selector.fd.seek(self._offset)
+                self.outgoing_file.position = self._offset
             self.msrp_session.send_file(self.outgoing_file)
+        elif self.sink is not None:
+            try:
+                self.file_writer = FileWriter(self, self.sink, self._offset)
+            except EnvironmentError, e:
+                NotificationCenter().post_notification('MediaStreamDidFail', self, TimestampedNotificationData(context='writing', failure=Failure(), reason=str(e)))
+
+    def _NH_MediaStreamDidEnd(self, notification):
+        if self.file_writer is not None:
+            self.file_writer.stop()
+            self.file_writer = None
 
     def _handle_REPORT(self, chunk):
         # in theory, REPORT can come with Byte-Range which would limit the scope of the REPORT to the part of the message.
         notification_center = NotificationCenter()
         data = TimestampedNotificationData(message_id=chunk.message_id, chunk=chunk, code=chunk.status.code, reason=chunk.status.comment)
         if chunk.status.code == 200:
-            # Calculating the number of bytes transferred so far by looking at the Byte-Range of this message
-            # only works as long as chunks are delivered in order. -Luci
-            data.transferred_bytes = chunk.byte_range[1]
+            self.transferred_ranges.add(chunk.byte_range[0]-1, chunk.byte_range[1])
+            data.transferred_bytes = len(self.transferred_ranges)
             data.file_size = chunk.byte_range[2]
             notification_center.post_notification('FileTransferStreamDidDeliverChunk', self, data)
             if data.transferred_bytes == data.file_size:
@@ -606,9 +1153,15 @@ class FileTransferStream(MSRPStreamBase):
             return
         # Note: success reports are issued by msrplib
         # TODO: check wrapped content-type and issue a report if it's invalid
-        # Calculating the number of bytes transferred so far by looking at the Byte-Range of this message
-        # only works as long as chunks are delivered in order. -Luci
-        ndata = TimestampedNotificationData(content=chunk.data, content_type=chunk.content_type, transferred_bytes=chunk.byte_range[0]+chunk.size-1, file_size=chunk.byte_range[2])
+        self.transferred_ranges.add(chunk.byte_range[0]-1, chunk.byte_range[0]-1+chunk.size)
+        transferred_bytes = len(self.transferred_ranges)
+        if self.file_writer is not None:
+            self.file_writer.write(chunk.byte_range[0]-1, chunk.data, transferred_bytes)
+            if transferred_bytes == chunk.byte_range[2]:
+                self.file_writer.finish()
+                self.file_writer = None
+            return
+        ndata = TimestampedNotificationData(content=chunk.data, content_type=chunk.content_type, transferred_bytes=transferred_bytes, file_size=chunk.byte_range[2])
         notification_center.post_notification('FileTransferStreamGotChunk', self, ndata)
         if ndata.transferred_bytes == ndata.file_size:
             notification_center.post_notification('FileTransferStreamDidFinish', self, TimestampedNotificationData())
@@ -627,6 +1180,55 @@ class IDesktopSharingHandler(Interface):
         pass
 
 
+class BoundedQueue(object):
+    """
+    A queue for passing data between greenlets which holds at most max_size
+    items. A greenlet which sends to the queue while it is full is paused
+    until an item is taken out of it, which stops it from reading more data
+    from its source. The main greenlet of the hub cannot be paused, so the
+    items it sends are queued even if the queue is full. The stalls and
+    overflows attributes count these two cases.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.stalls = 0
+        self.overflows = 0
+        self._queue = queue()
+        self._space_waiters = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send(self, data):
+        while len(self._queue) >= self.max_size:
+            if api.getcurrent() is api.get_hub().greenlet:
+                self.overflows += 1
+                break
+            self.stalls += 1
+            waiter = event()
+            self._space_waiters.append(waiter)
+            try:
+                waiter.wait()
+            except:
+                if waiter in self._space_waiters:
+                    self._space_waiters.remove(waiter)
+                raise
+        self._queue.send(data)
+
+    def send_exception(self, *args):
+        self._queue.send_exception(*args)
+
+    def ready(self):
+        return self._queue.ready()
+
+    def wait(self):
+        data = self._queue.wait()
+        if self._space_waiters and len(self._queue) < self.max_size:
+            self._space_waiters.popleft().send()
+        return data
+
+
 class DesktopSharingHandlerBase(object):
     implements(IDesktopSharingHandler, IObserver)
 
@@ -663,7 +1265,7 @@ class DesktopSharingHandlerBase(object):
 
     def _NH_MediaStreamDidStart(self, notification):
         self.msrp_reader_thread = spawn(self._msrp_reader)
-        self.msrp_writer_thread = spawn(self._msrp_reader)
+        self.msrp_writer_thread = spawn(self._msrp_writer)
 
     def _NH_MediaStreamWillEnd(self, notification):
         NotificationCenter().remove_observer(self, sender=notification.sender)
@@ -847,6 +1449,18 @@ class ExternalVNCServerHandler(DesktopSharingHandlerBase):
 
 
 class DesktopSharingStream(MSRPStreamBase):
+    """
+    A desktop sharing stream. The data sent by the handler is coalesced into
+    chunks of at most max_chunk_size bytes: the writer takes all the data which
+    is pending and, if there is not enough of it, waits coalesce_latency
+    seconds for more before sending a chunk. The queue_depth, sent_chunks,
+    sent_bytes and bytes_per_chunk attributes can be used to tune these.
+
+    The data is exchanged with the handler through two BoundedQueue objects
+    of max_queue_size items: when the network is slower than the VNC source
+    the handler stops reading from it and, likewise, the stream stops reading
+    from the MSRP transport when the handler does not keep up.
+    """
 
     type = 'desktop-sharing'
     priority = 1
@@ -856,13 +1470,31 @@ class DesktopSharingStream(MSRPStreamBase):
     accept_types = ['application/x-rfb']
     accept_wrapped_types = None
 
+    max_chunk_size = 16384
+    coalesce_latency = 0.005
+    max_queue_size = 64
+
     def __init__(self, account, handler):
         MSRPStreamBase.__init__(self, account, direction='sendrecv')
         self.handler = handler
-        self.incoming_queue = queue()
-        self.outgoing_queue = queue()
+        self.incoming_queue = BoundedQueue(self.max_queue_size)
+        self.outgoing_queue = BoundedQueue(self.max_queue_size)
         self.msrp_reader_thread = None
         self.msrp_writer_thread = None
+        self.sent_chunks = 0
+        self.sent_bytes = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.outgoing_queue)
+
+    @property
+    def incoming_queue_depth(self):
+        return len(self.incoming_queue)
+
+    @property
+    def bytes_per_chunk(self):
+        return self.sent_bytes / self.sent_chunks if self.sent_chunks else 0
 
     def _get_handler(self):
         return self.__dict__['handler']
@@ -927,10 +1559,12 @@ class DesktopSharingStream(MSRPStreamBase):
                 else:
                     response = make_response(chunk, 501, 'Unknown method')
                     report = None
+                # make_response and make_report return None when the Failure-Report and
+                # Success-Report headers of the chunk say that they are not wanted
                 if response is not None:
                     self.msrp.write_chunk(response)
                 if report is not None:
-                    self.msrp.write_chunk(response)
+                    self.msrp.write_chunk(report)
             except ProcExit:
                 raise
             except Exception, e:
@@ -944,12 +1578,23 @@ class DesktopSharingStream(MSRPStreamBase):
     def _msrp_writer(self):
         while True:
             try:
-                data = self.outgoing_queue.wait()
-                chunk = self.msrp.make_chunk(data=data)
-                chunk.add_header(SuccessReportHeader('no'))
-                chunk.add_header(FailureReportHeader('partial'))
-                chunk.add_header(ContentTypeHeader('application/x-rfb'))
-                self.msrp.write_chunk(chunk)
+                data = [self.outgoing_queue.wait()]
+                size = len(data[0])
+                if size < self.max_chunk_size and self.coalesce_latency and not self.outgoing_queue.ready():
+                    api.sleep(self.coalesce_latency)
+                while size < self.max_chunk_size and self.outgoing_queue.ready():
+                    data.append(self.outgoing_queue.wait())
+                    size += len(data[-1])
+                # the last item taken may exceed the size budget, so the data is split at max_chunk_size
+                data = ''.join(data)
+                for offset in xrange(0, size, self.max_chunk_size):
+                    chunk = self.msrp.make_chunk(data=data[offset:offset+self.max_chunk_size])
+                    chunk.add_header(SuccessReportHeader('no'))
+                    chunk.add_header(FailureReportHeader('partial'))
+                    chunk.add_header(ContentTypeHeader('application/x-rfb'))
+                    self.msrp.write_chunk(chunk)
+                    self.sent_chunks += 1
+                self.sent_bytes += size
             except ProcExit:
                 raise
             except Exception, e:
@@ -980,11 +1625,23 @@ class DesktopSharingStream(MSRPStreamBase):
 
 # temporary solution. to be replaced later by a better logging system in msrplib -Dan
 class NotificationProxyLogger(object):
+    """
+    Logger for msrplib which posts the MSRP traffic in MSRPTransportTrace
+    notifications and the log messages in MSRPLibraryLog notifications.
+
+    The chunks are only traced if the logs.trace_msrp setting is enabled when
+    they start, so applications which do not observe the traces can disable
+    it. The data of chunks which do not contain text is replaced with a
+    marker, and at most max_trace_size bytes are collected for each chunk,
+    the rest being replaced with a marker as well.
+    """
+
+    max_trace_size = 65536
+
     def __init__(self):
         from application import log
         self.level = log.level
-        self.stripped_data_transactions = set()
-        self.text_transactions = set()
+        # maps the transaction ID to [fragments, size, is_text, is_stripped]
         self.transaction_data = {}
 
     def report_out(self, data, transport, new_chunk=True):
@@ -994,42 +1651,56 @@ class NotificationProxyLogger(object):
         pass
 
     def received_new_chunk(self, data, transport, chunk):
-        content_type = chunk.content_type.split('/')[0].lower() if chunk.content_type else None
-        if chunk.method != 'SEND' or (chunk.content_type and content_type in ('text', 'message')):
-            self.text_transactions.add(chunk.transaction_id)
-        self.transaction_data[chunk.transaction_id] = data
+        self._new_chunk(data, transport, chunk)
 
     def received_chunk_data(self, data, transport, transaction_id):
-        if transaction_id in self.text_transactions:
-            self.transaction_data[transaction_id] += data
-        elif transaction_id not in self.stripped_data_transactions:
-            self.transaction_data[transaction_id] += '<stripped data>'
-            self.stripped_data_transactions.add(transaction_id)
+        self._chunk_data(data, transaction_id)
 
     def received_chunk_end(self, data, transport, transaction_id):
-        chunk = self.transaction_data.pop(transaction_id) + data
-        self.stripped_data_transactions.discard(transaction_id)
-        self.text_transactions.discard(transaction_id)
-        NotificationCenter().post_notification('MSRPTransportTrace', sender=transport, data=TimestampedNotificationData(direction='incoming', data=chunk))
+        self._chunk_end(data, transport, transaction_id, 'incoming')
 
     def sent_new_chunk(self, data, transport, chunk):
-        content_type = chunk.content_type.split('/')[0].lower() if chunk.content_type else None
-        if chunk.method != 'SEND' or (chunk.content_type and content_type in ('text', 'message')):
-            self.text_transactions.add(chunk.transaction_id)
-        self.transaction_data[chunk.transaction_id] = data
+        self._new_chunk(data, transport, chunk)
 
     def sent_chunk_data(self, data, transport, transaction_id):
-        if transaction_id in self.text_transactions:
-            self.transaction_data[transaction_id] += data
-        elif transaction_id not in self.stripped_data_transactions:
-            self.transaction_data[transaction_id] += '<stripped data>'
-            self.stripped_data_transactions.add(transaction_id)
+        self._chunk_data(data, transaction_id)
 
     def sent_chunk_end(self, data, transport, transaction_id):
-        chunk = self.transaction_data.pop(transaction_id) + data
-        self.stripped_data_transactions.discard(transaction_id)
-        self.text_transactions.discard(transaction_id)
-        NotificationCenter().post_notification('MSRPTransportTrace', sender=transport, data=TimestampedNotificationData(direction='outgoing', data=chunk))
+        self._chunk_end(data, transport, transaction_id, 'outgoing')
+
+    def _new_chunk(self, data, transport, chunk):
+        if not SIPSimpleSettings().logs.trace_msrp:
+            return
+        content_type = chunk.content_type.split('/')[0].lower() if chunk.content_type else None
+        is_text = chunk.method != 'SEND' or (chunk.content_type and content_type in ('text', 'message'))
+        self.transaction_data[chunk.transaction_id] = [[data], len(data), is_text, False]
+
+    def _chunk_data(self, data, transaction_id):
+        try:
+            entry = self.transaction_data[transaction_id]
+        except KeyError:
+            return
+        fragments, size, is_text, is_stripped = entry
+        if is_stripped:
+            return
+        if not is_text:
+            fragments.append('<stripped data>')
+            entry[3] = True
+        elif size + len(data) > self.max_trace_size:
+            fragments.append(data[:self.max_trace_size-size])
+            fragments.append('<truncated data>')
+            entry[3] = True
+        else:
+            fragments.append(data)
+            entry[1] = size + len(data)
+
+    def _chunk_end(self, data, transport, transaction_id, direction):
+        try:
+            fragments = self.transaction_data.pop(transaction_id)[0]
+        except KeyError:
+            return
+        fragments.append(data)
+        NotificationCenter().post_notification('MSRPTransportTrace', sender=transport, data=TimestampedNotificationData(direction=direction, data=''.join(fragments)))
 
     def debug(self, message, **context):
         pass
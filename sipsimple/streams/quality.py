@@ -0,0 +1,201 @@
+# Copyright (C) 2010 AG Projects. See LICENSE for details.
+#
+
+"""
+Estimation of the quality of audio streams from their RTCP statistics, using
+the simplified E-model from ITU-T G.107 and the codec impairment values from
+ITU-T G.113. The estimates are computed for all the rows of a statistics
+snapshot taken by RTPStatisticsSampler at once, using NumPy if it is
+available and falling back to pure Python otherwise.
+"""
+
+from __future__ import with_statement
+
+__all__ = ['QualityEstimate', 'QualityMonitor', 'estimate_quality']
+
+import weakref
+from threading import RLock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from application.notification import IObserver, NotificationCenter
+from application.python.util import Null, Singleton
+from zope.interface import implements
+
+from sipsimple.core import RTP_STATISTICS_FIELDS
+from sipsimple.util import TimestampedNotificationData
+
+
+# The equipment impairment factor (Ie) and the packet loss robustness factor
+# (Bpl) of the codecs, from ITU-T G.113 Appendix I
+codec_impairments = {'PCMU':  (0, 25.1),
+                     'PCMA':  (0, 25.1),
+                     'G722':  (0, 25.1),
+                     'speex': (11, 19.0),
+                     'iLBC':  (11, 32.0),
+                     'GSM':   (20, 10.0)}
+default_codec_impairment = (0, 25.1)
+
+# The rating categories of ITU-T G.109, as (minimum R factor, name) pairs
+quality_levels = ((90, 'excellent'), (80, 'good'), (70, 'fair'), (60, 'poor'), (0, 'bad'))
+
+
+class QualityEstimate(object):
+    """
+    The quality estimates of the rows of a statistics snapshot. Each attribute
+    is a sequence with one item per row (a NumPy array if NumPy is available):
+     * r_factor: the E-model transmission rating factor (0-100)
+     * mos: the mean opinion score derived from the R factor (1-4.5)
+     * packet_loss: the percentage of lost packets
+     * burst_ratio: the ratio between the observed average length of the loss
+       bursts and the one expected for random loss (1 for random loss)
+     * jitter: the average interarrival jitter in milliseconds
+     * jitter_max: the maximum interarrival jitter in milliseconds
+     * delay: the estimated one-way delay in milliseconds
+    """
+
+    def __init__(self, r_factor, mos, packet_loss, burst_ratio, jitter, jitter_max, delay):
+        self.r_factor = r_factor
+        self.mos = mos
+        self.packet_loss = packet_loss
+        self.burst_ratio = burst_ratio
+        self.jitter = jitter
+        self.jitter_max = jitter_max
+        self.delay = delay
+
+    def __len__(self):
+        return len(self.r_factor)
+
+    def __getitem__(self, index):
+        return dict(r_factor=float(self.r_factor[index]), mos=float(self.mos[index]), packet_loss=float(self.packet_loss[index]), burst_ratio=float(self.burst_ratio[index]),
+                    jitter=float(self.jitter[index]), jitter_max=float(self.jitter_max[index]), delay=float(self.delay[index]))
+
+
+def estimate_quality(statistics, count, codecs=None, baseline=None, ptime=20, fields=RTP_STATISTICS_FIELDS):
+    """
+    Estimate the quality of the first count rows of statistics, a buffer in
+    the layout described by fields such as the ones taken by
+    RTPStatisticsSampler. The codecs argument may give the codec used by each
+    row, which determines its impairment factors. If baseline is given, it
+    must be a sequence of count (packets, lost packets) pairs, or None for
+    the rows without one, which are subtracted from the received packet
+    counters so that the loss is computed over an interval. Returns a
+    QualityEstimate object.
+    """
+    field_count = len(fields)
+    columns = dict((name, index) for index, name in enumerate(fields))
+    impairments = [codec_impairments.get(codec, default_codec_impairment) for codec in (codecs or [None]*count)]
+    baseline = [entry or (0, 0) for entry in (baseline or [None]*count)]
+    if numpy is not None:
+        rows = numpy.frombuffer(statistics, dtype=numpy.uint32, count=count*field_count).reshape(count, field_count).astype(numpy.float64)
+        column = lambda name: rows[:, columns[name]]
+        ie = numpy.array([item[0] for item in impairments], dtype=numpy.float64)
+        bpl = numpy.array([item[1] for item in impairments], dtype=numpy.float64)
+        packets = column('rx_packets') - numpy.array([entry[0] for entry in baseline], dtype=numpy.float64)
+        lost = column('rx_packets_lost') - numpy.array([entry[1] for entry in baseline], dtype=numpy.float64)
+        total = numpy.maximum(packets + lost, 1)
+        ppl = 100 * numpy.clip(lost, 0, None) / total
+        loss_probability = ppl / 100
+        burst_length = numpy.maximum(column('rx_loss_period_avg') / (ptime * 1000.0), 1)
+        burst_ratio = numpy.where(lost > 0, numpy.maximum(burst_length * (1 - loss_probability), 1), 1)
+        jitter = column('rx_jitter_avg') / 1000.0
+        jitter_max = column('rx_jitter_max') / 1000.0
+        rtt = numpy.where(column('rtt_count') > 0, column('rtt_last') / 1000.0, 0)
+        # the jitter buffer is assumed to hold twice the average jitter
+        delay = rtt / 2 + 2 * jitter + ptime
+        idd = 0.024 * delay + 0.11 * numpy.clip(delay - 177.3, 0, None)
+        ie_eff = ie + (95 - ie) * ppl / (ppl / burst_ratio + bpl)
+        r_factor = numpy.clip(93.2 - idd - ie_eff, 0, 100)
+        mos = numpy.clip(1 + 0.035 * r_factor + r_factor * (r_factor - 60) * (100 - r_factor) * 7e-6, 1, 4.5)
+        return QualityEstimate(r_factor, mos, ppl, burst_ratio, jitter, jitter_max, delay)
+    else:
+        results = dict(r_factor=[], mos=[], packet_loss=[], burst_ratio=[], jitter=[], jitter_max=[], delay=[])
+        for index in xrange(count):
+            row = statistics[index*field_count:(index+1)*field_count]
+            column = lambda name: float(row[columns[name]])
+            ie, bpl = impairments[index]
+            packets = column('rx_packets') - baseline[index][0]
+            lost = column('rx_packets_lost') - baseline[index][1]
+            ppl = 100 * max(lost, 0) / max(packets + lost, 1)
+            burst_length = max(column('rx_loss_period_avg') / (ptime * 1000.0), 1)
+            burst_ratio = max(burst_length * (1 - ppl / 100), 1) if lost > 0 else 1
+            jitter = column('rx_jitter_avg') / 1000.0
+            jitter_max = column('rx_jitter_max') / 1000.0
+            rtt = column('rtt_last') / 1000.0 if column('rtt_count') > 0 else 0
+            delay = rtt / 2 + 2 * jitter + ptime
+            idd = 0.024 * delay + 0.11 * max(delay - 177.3, 0)
+            ie_eff = ie + (95 - ie) * ppl / (ppl / burst_ratio + bpl)
+            r_factor = min(max(93.2 - idd - ie_eff, 0), 100)
+            mos = min(max(1 + 0.035 * r_factor + r_factor * (r_factor - 60) * (100 - r_factor) * 7e-6, 1), 4.5)
+            for name, value in (('r_factor', r_factor), ('mos', mos), ('packet_loss', ppl), ('burst_ratio', burst_ratio), ('jitter', jitter), ('jitter_max', jitter_max), ('delay', delay)):
+                results[name].append(value)
+        return QualityEstimate(**results)
+
+
+class QualityMonitor(object):
+    """
+    Estimates the quality of all the audio streams from the snapshots posted
+    by RTPStatisticsSampler and posts an AudioStreamQualityDidChange
+    notification for a stream whenever its quality crosses into a different
+    level of quality_levels. The packet loss is computed over the interval
+    between consecutive snapshots.
+    """
+
+    __metaclass__ = Singleton
+
+    implements(IObserver)
+
+    def __init__(self):
+        self.estimates = weakref.WeakKeyDictionary()
+        self._levels = weakref.WeakKeyDictionary()
+        self._counters = weakref.WeakKeyDictionary()
+        self._lock = RLock()
+
+    def start(self):
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='RTPStatisticsSamplerDidSample')
+
+    def stop(self):
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='RTPStatisticsSamplerDidSample')
+        with self._lock:
+            self.estimates.clear()
+            self._levels.clear()
+            self._counters.clear()
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_RTPStatisticsSamplerDidSample(self, notification):
+        streams = notification.data.streams
+        statistics = notification.data.statistics
+        fields = notification.data.fields
+        packets_column = fields.index('rx_packets')
+        lost_column = fields.index('rx_packets_lost')
+        notification_center = NotificationCenter()
+        with self._lock:
+            counters = [(statistics[index*len(fields)+packets_column], statistics[index*len(fields)+lost_column]) for index in xrange(len(streams))]
+            baseline = []
+            for stream, current in zip(streams, counters):
+                previous = self._counters.get(stream) if stream is not None else None
+                # the counters start again from 0 when the stream changes its transport
+                baseline.append(previous if previous is not None and previous[0] <= current[0] and previous[1] <= current[1] else None)
+            codecs = [stream.codec if stream is not None else None for stream in streams]
+            estimate = estimate_quality(statistics, len(streams), codecs=codecs, baseline=baseline, fields=fields)
+            changes = []
+            for index, stream in enumerate(streams):
+                if stream is None:
+                    continue
+                self._counters[stream] = counters[index]
+                quality = estimate[index]
+                level = (name for threshold, name in quality_levels if quality['r_factor'] >= threshold).next()
+                self.estimates[stream] = quality
+                if self._levels.get(stream) != level:
+                    changes.append((stream, self._levels.get(stream), level, quality))
+                    self._levels[stream] = level
+        for stream, old_level, level, quality in changes:
+            notification_center.post_notification('AudioStreamQualityDidChange', sender=stream, data=TimestampedNotificationData(old_level=old_level, level=level, **quality))
@@ -8,21 +8,233 @@ RFC2833 and RFC3711, RFC3489 and draft-ietf-mmusic-ice-19.
 
 from __future__ import with_statement
 
-__all__ = ['AudioStream']
+__all__ = ['AudioStream', 'RTPStatisticsSampler', 'RTPTransportPool']
 
+import weakref
+from array import array
+from collections import deque
 from threading import RLock
+from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
-from application.python.util import Null
+from application.python.util import Null, Singleton
+from twisted.internet import reactor
 from zope.interface import implements
 
 from sipsimple.account import BonjourAccount
 from sipsimple.audio import AudioBridge, AudioDevice, IAudioPort, WaveRecorder
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.core import AudioTransport, PJSIPError, RTPTransport, SIPCoreError, SIPURI
-from sipsimple.lookup import DNSLookup
+from sipsimple.core import AudioTransport, PJSIPError, RTP_STATISTICS_FIELDS, RTPTransport, SIPCoreError, SIPURI
+from sipsimple.lookup import DNSLookup, STUNServerRegistry
 from sipsimple.streams import IMediaStream, InvalidStreamError, MediaStreamRegistrar, UnknownStreamError
-from sipsimple.util import TimestampedNotificationData
+from sipsimple.util import TimestampedNotificationData, run_in_twisted_thread
+
+
+class RTPTransportPool(object):
+    """
+    A pool of initialized RTP transports for an account, which allows audio
+    streams to skip binding the RTP ports and gathering the ICE candidates
+    when a call is set up. For each combination of transport parameters which
+    was requested, the pool is refilled in the background up to
+    account.rtp.transport_pool_size transports. Transports which are older
+    than max_age seconds are replaced, so that their ICE candidates are kept
+    up to date. A pool size of 0 disables the pool.
+    """
+
+    implements(IObserver)
+
+    max_age = 300
+
+    _pools = weakref.WeakKeyDictionary()
+
+    def __init__(self, account):
+        self._account = weakref.ref(account, self._account_died)
+        self._lock = RLock()
+        self._transports = {}
+        self._pending = {}
+        self._creation_times = weakref.WeakKeyDictionary()
+        self._stun_servers = None
+        self._stun_lookup = None
+        self._refresh_timer = None
+        self.hits = 0
+        self.misses = 0
+        NotificationCenter().add_observer(self, name='SystemIPAddressDidChange')
+
+    @classmethod
+    def for_account(cls, account):
+        try:
+            return cls._pools[account]
+        except KeyError:
+            return cls._pools.setdefault(account, cls(account))
+
+    @property
+    def size(self):
+        account = self._account()
+        return account.rtp.transport_pool_size if account is not None else 0
+
+    @property
+    def statistics(self):
+        with self._lock:
+            return dict(available=sum(len(transports) for transports in self._transports.itervalues()), pending=len(self._pending), hits=self.hits, misses=self.misses)
+
+    def get(self, use_srtp=False, srtp_forced=False, use_ice=False):
+        """
+        Return an initialized RTPTransport with the specified parameters or
+        None if the pool doesn't have one available.
+        """
+        if self.size == 0:
+            return None
+        parameters = (use_srtp, srtp_forced, use_ice)
+        with self._lock:
+            transports = self._transports.setdefault(parameters, deque())
+            expiration = time() - self.max_age
+            rtp_transport = None
+            while transports:
+                timestamp, transport = transports.pop()
+                if timestamp > expiration and transport.state == 'INIT':
+                    rtp_transport = transport
+                    self._creation_times[rtp_transport] = timestamp
+                    break
+            if rtp_transport is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._refill()
+        return rtp_transport
+
+    def put(self, rtp_transport):
+        """
+        Return an RTPTransport which is no longer used to the pool. It is only
+        kept if it is back in the INIT state and the pool is not full.
+        """
+        parameters = (rtp_transport.use_srtp, rtp_transport.srtp_forced, rtp_transport.use_ice)
+        with self._lock:
+            # the transports keep the time when they were created, so that they are replaced after
+            # max_age even if they are reused, the ones which were not created by the pool count
+            # from the time when they are returned to it
+            timestamp = self._creation_times.pop(rtp_transport, None) or time()
+            transports = self._transports.get(parameters)
+            if transports is not None and rtp_transport.state == 'INIT' and len(transports) < self.size and timestamp > time() - self.max_age:
+                transports.append((timestamp, rtp_transport))
+
+    def flush(self):
+        with self._lock:
+            self._transports = dict((parameters, deque()) for parameters in self._transports)
+            self._stun_servers = None
+        self._refill()
+
+    @run_in_twisted_thread
+    def _refill(self):
+        notification_center = NotificationCenter()
+        account = self._account()
+        with self._lock:
+            size = self.size
+            if account is None or size == 0:
+                self._transports = {}
+                return
+            expiration = time() - self.max_age
+            for parameters, transports in self._transports.items():
+                # the reused transports are not necessarily in the order of their creation
+                transports = self._transports[parameters] = deque(entry for entry in transports if entry[0] > expiration)
+                use_srtp, srtp_forced, use_ice = parameters
+                if use_ice and self._stun_servers is None:
+                    self._lookup_stun_servers(account)
+                    if self._stun_servers is None:
+                        continue
+                missing = size - len(transports) - self._pending.values().count(parameters)
+                for i in xrange(missing):
+                    stun_address, stun_port = STUNServerRegistry().sort_servers(self._stun_servers)[0] if use_ice and self._stun_servers else (None, None)
+                    rtp_transport = None
+                    try:
+                        rtp_transport = RTPTransport(use_srtp=use_srtp, srtp_forced=srtp_forced, use_ice=use_ice, ice_stun_address=stun_address, ice_stun_port=stun_port)
+                        notification_center.add_observer(self, sender=rtp_transport)
+                        self._pending[rtp_transport] = parameters
+                        rtp_transport.set_INIT()
+                    except SIPCoreError:
+                        if rtp_transport is not None and self._pending.pop(rtp_transport, None) is not None:
+                            notification_center.remove_observer(self, sender=rtp_transport)
+                        break
+            if self._refresh_timer is None and self._transports:
+                self._refresh_timer = reactor.callLater(self.max_age/2, self._refresh)
+
+    def _refresh(self):
+        self._refresh_timer = None
+        self._refill()
+
+    def _account_died(self, account_ref):
+        # the notification center keeps the pool alive, so it must release itself along with its transports
+        reactor.callFromThread(self._discard)
+
+    def _discard(self):
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='SystemIPAddressDidChange')
+        with self._lock:
+            if self._refresh_timer is not None and self._refresh_timer.active():
+                self._refresh_timer.cancel()
+            self._refresh_timer = None
+            for rtp_transport in self._pending:
+                notification_center.remove_observer(self, sender=rtp_transport)
+            if self._stun_lookup is not None:
+                notification_center.remove_observer(self, sender=self._stun_lookup)
+            self._transports = {}
+            self._pending = {}
+            self._stun_servers = None
+            self._stun_lookup = None
+
+    def _lookup_stun_servers(self, account):
+        if self._stun_lookup is not None:
+            return
+        if account.nat_traversal.stun_server_list:
+            # Assume these are IP addresses
+            self._stun_servers = STUNServerRegistry().use_servers((server.host, server.port) for server in account.nat_traversal.stun_server_list)
+        elif isinstance(account, BonjourAccount):
+            self._stun_servers = []
+        else:
+            self._stun_servers = STUNServerRegistry().get_servers(account.id.domain)
+            if self._stun_servers is not None:
+                return
+            self._stun_lookup = DNSLookup()
+            NotificationCenter().add_observer(self, sender=self._stun_lookup)
+            self._stun_lookup.lookup_service(SIPURI(account.id.domain), "stun")
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_DNSLookupDidSucceed(self, notification):
+        NotificationCenter().remove_observer(self, sender=notification.sender)
+        account = self._account()
+        with self._lock:
+            self._stun_lookup = None
+            self._stun_servers = STUNServerRegistry().add_servers(account.id.domain, notification.data.result) if account is not None else []
+        self._refill()
+
+    def _NH_DNSLookupDidFail(self, notification):
+        NotificationCenter().remove_observer(self, sender=notification.sender)
+        with self._lock:
+            self._stun_lookup = None
+            self._stun_servers = []
+        self._refill()
+
+    def _NH_RTPTransportDidInitialize(self, notification):
+        rtp_transport = notification.sender
+        NotificationCenter().remove_observer(self, sender=rtp_transport)
+        with self._lock:
+            parameters = self._pending.pop(rtp_transport, None)
+            if parameters in self._transports:
+                self._transports[parameters].append((time(), rtp_transport))
+
+    def _NH_RTPTransportDidFail(self, notification):
+        rtp_transport = notification.sender
+        NotificationCenter().remove_observer(self, sender=rtp_transport)
+        with self._lock:
+            self._pending.pop(rtp_transport, None)
+        # The following transports will use the next STUN server
+        if rtp_transport.ice_stun_address is not None and STUNServerRegistry.is_stun_failure(notification.data.reason):
+            STUNServerRegistry().failure(rtp_transport.ice_stun_address, rtp_transport.ice_stun_port)
+
+    def _NH_SystemIPAddressDidChange(self, notification):
+        self.flush()
 
 
 class AudioStream(object):
@@ -30,17 +242,19 @@ class AudioStream(object):
 
     implements(IMediaStream, IAudioPort, IObserver)
 
-    _streams = []
+    # the streams are kept alive while they are in use, from initialize() until end()
+    _streams = set()
+    _transport_streams = weakref.WeakKeyDictionary()
 
     type = 'audio'
     priority = 1
 
     hold_supported = True
 
-    def __init__(self, account):
+    def __init__(self, account, mixer=None):
         from sipsimple.application import SIPApplication
         self.account = account
-        self.mixer = SIPApplication.voice_audio_mixer
+        self.mixer = SIPApplication.get_audio_mixer(self, mixer)
         self.bridge = AudioBridge(self.mixer)
         self.device = AudioDevice(self.mixer)
         self.notification_center = NotificationCenter()
@@ -186,9 +400,9 @@ class AudioStream(object):
 
     def initialize(self, session, direction):
         with self._lock:
-            self._streams.append(self)
             if self.state != "NULL":
                 raise RuntimeError("AudioStream.initialize() may only be called in the NULL state")
+            self._streams.add(self)
             self.state = "INITIALIZING"
             self._session = session
             if hasattr(self, "_incoming_remote_sdp"):
@@ -208,15 +422,24 @@ class AudioStream(object):
                 self._try_ice = self.account.nat_traversal.use_ice
                 self._use_srtp = ((self._session.transport == "tls" or self.account.rtp.use_srtp_without_tls) and self.account.rtp.srtp_encryption != "disabled")
                 self._try_forced_srtp = self.account.rtp.srtp_encryption == "mandatory" 
-            if self._try_ice:
+            rtp_transport = RTPTransportPool.for_account(self.account).get(use_srtp=self._use_srtp, srtp_forced=self._use_srtp and self._try_forced_srtp, use_ice=self._try_ice)
+            if rtp_transport is not None:
+                if rtp_transport.use_ice:
+                    self.notification_center.add_observer(self, sender=rtp_transport)
+                self._create_audio_transport(rtp_transport)
+            elif self._try_ice:
+                stun_registry = STUNServerRegistry()
                 if self.account.nat_traversal.stun_server_list:
                     # Assume these are IP addresses
-                    stun_servers = list((server.host, server.port) for server in self.account.nat_traversal.stun_server_list)
-                    self._init_rtp_transport(stun_servers)
+                    self._init_rtp_transport(stun_registry.use_servers((server.host, server.port) for server in self.account.nat_traversal.stun_server_list))
                 elif not isinstance(self.account, BonjourAccount):
-                    dns_lookup = DNSLookup()
-                    self.notification_center.add_observer(self, sender=dns_lookup)
-                    dns_lookup.lookup_service(SIPURI(self.account.id.domain), "stun")
+                    stun_servers = stun_registry.get_servers(self.account.id.domain)
+                    if stun_servers is not None:
+                        self._init_rtp_transport(stun_servers)
+                    else:
+                        dns_lookup = DNSLookup()
+                        self.notification_center.add_observer(self, sender=dns_lookup)
+                        dns_lookup.lookup_service(SIPURI(self.account.id.domain), "stun")
             else:
                 self._init_rtp_transport()
 
@@ -277,6 +500,7 @@ class AudioStream(object):
                     self.notification_center.post_notification("MediaStreamDidFail", self,
                                                                TimestampedNotificationData(reason=e.args[0]))
                     return
+                self._transport_streams[self._audio_transport] = weakref.ref(self)
                 self.notification_center.add_observer(self, sender=self._audio_transport)
                 self._audio_transport.start(local_sdp, remote_sdp, stream_index, no_media_timeout=settings.rtp.timeout,
                                             media_check_interval=settings.rtp.timeout)
@@ -321,14 +545,19 @@ class AudioStream(object):
                     self._audio_transport.stop()
                     self.notification_center.remove_observer(self, sender=self._audio_transport)
                     self._audio_transport = None
+                    # Only reuse the transport if we no longer observe it
+                    if not self._rtp_transport.use_ice or self._ice_state in ("IN_USE", "FAILED"):
+                        RTPTransportPool.for_account(self.account).put(self._rtp_transport)
                     self._rtp_transport = None
                     self.state = "ENDED"
                     self.notification_center.post_notification("MediaStreamDidEnd", self,
                                                                TimestampedNotificationData())
                 else:
                     self.state = "ENDED"
-                self.bridge.stop()
-                self._session = None
+            # a stream which failed is already in the ENDED state, but its resources must still be released
+            self.bridge.stop()
+            self._session = None
+            self._streams.discard(self)
 
     def send_dtmf(self, digit):
         with self._lock:
@@ -373,19 +602,22 @@ class AudioStream(object):
     def _NH_DNSLookupDidSucceed(self, notification):
         with self._lock:
             self.notification_center.remove_observer(self, sender=notification.sender)
+            stun_servers = STUNServerRegistry().add_servers(self.account.id.domain, notification.data.result)
             if self.state == "ENDED":
                 return
-            self._init_rtp_transport(notification.data.result)
+            self._init_rtp_transport(stun_servers)
 
     def _NH_RTPTransportDidFail(self, notification):
+        rtp_transport = notification.sender
+        if rtp_transport.ice_stun_address is not None and STUNServerRegistry.is_stun_failure(notification.data.reason):
+            STUNServerRegistry().failure(rtp_transport.ice_stun_address, rtp_transport.ice_stun_port)
         with self._lock:
-            self.notification_center.remove_observer(self, sender=notification.sender)
+            self.notification_center.remove_observer(self, sender=rtp_transport)
             if self.state == "ENDED":
                 return
             self._try_next_rtp_transport(notification.data.reason)
 
     def _NH_RTPTransportDidInitialize(self, notification):
-        settings = SIPSimpleSettings()
         rtp_transport = notification.sender
         with self._lock:
             if not rtp_transport.use_ice:
@@ -394,30 +626,7 @@ class AudioStream(object):
                 return
             del self._rtp_args
             del self._stun_servers
-            try:
-                if hasattr(self, "_incoming_remote_sdp"):
-                    try:
-                        audio_transport = AudioTransport(self.mixer, rtp_transport,
-                                                         self._incoming_remote_sdp, self._incoming_stream_index,
-                                                         codecs=(list(self.account.rtp.audio_codec_list)
-                                                                 if self.account.rtp.audio_codec_list else list(settings.rtp.audio_codec_list)))
-                    finally:
-                        del self._incoming_remote_sdp
-                        del self._incoming_stream_index
-                else:
-                    audio_transport = AudioTransport(self.mixer, rtp_transport,
-                                                     codecs=(list(self.account.rtp.audio_codec_list) 
-                                                             if self.account.rtp.audio_codec_list else list(settings.rtp.audio_codec_list)))
-            except SIPCoreError, e:
-                self.state = "ENDED"
-                self.notification_center.post_notification("MediaStreamDidFail", self,
-                                                           TimestampedNotificationData(reason=e.args[0]))
-                return
-            self._rtp_transport = rtp_transport
-            self._audio_transport = audio_transport
-            self.notification_center.add_observer(self, sender=audio_transport)
-            self.state = "INITIALIZED"
-            self.notification_center.post_notification("MediaStreamDidInitialize", self, TimestampedNotificationData())
+            self._create_audio_transport(rtp_transport)
 
     def _NH_RTPAudioStreamGotDTMF(self, notification):
         self.notification_center.post_notification("AudioStreamGotDTMF", self,
@@ -452,6 +661,34 @@ class AudioStream(object):
     # Private methods
     #
 
+    def _create_audio_transport(self, rtp_transport):
+        settings = SIPSimpleSettings()
+        try:
+            if hasattr(self, "_incoming_remote_sdp"):
+                try:
+                    audio_transport = AudioTransport(self.mixer, rtp_transport,
+                                                     self._incoming_remote_sdp, self._incoming_stream_index,
+                                                     codecs=(list(self.account.rtp.audio_codec_list)
+                                                             if self.account.rtp.audio_codec_list else list(settings.rtp.audio_codec_list)))
+                finally:
+                    del self._incoming_remote_sdp
+                    del self._incoming_stream_index
+            else:
+                audio_transport = AudioTransport(self.mixer, rtp_transport,
+                                                 codecs=(list(self.account.rtp.audio_codec_list) 
+                                                         if self.account.rtp.audio_codec_list else list(settings.rtp.audio_codec_list)))
+        except SIPCoreError, e:
+            self.state = "ENDED"
+            self.notification_center.post_notification("MediaStreamDidFail", self,
+                                                       TimestampedNotificationData(reason=e.args[0]))
+            return
+        self._rtp_transport = rtp_transport
+        self._audio_transport = audio_transport
+        self._transport_streams[audio_transport] = weakref.ref(self)
+        self.notification_center.add_observer(self, sender=audio_transport)
+        self.state = "INITIALIZED"
+        self.notification_center.post_notification("MediaStreamDidInitialize", self, TimestampedNotificationData())
+
     def _init_rtp_transport(self, stun_servers=None):
         self._rtp_args = dict()
         self._rtp_args["use_srtp"] = self._use_srtp
@@ -532,3 +769,78 @@ class AudioStream(object):
                                                        TimestampedNotificationData(filename=self._audio_rec.filename))
             self._audio_rec = None
 
+
+class RTPStatisticsSampler(object):
+    """
+    Takes snapshots of the RTP statistics of all the audio streams using a
+    single call per mixer, instead of building the statistics dictionary of
+    each stream. A snapshot consists of the list of streams and a buffer of
+    unsigned 32-bit integers in which row i, made of len(RTP_STATISTICS_FIELDS)
+    items, holds the statistics of the i-th stream. The buffer is an
+    array.array('I'), which can be wrapped in a numpy array without copying.
+
+    When started, the sampler posts a RTPStatisticsSamplerDidSample
+    notification with the latest snapshot every interval seconds.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.interval = None
+        self._buffer = array('I')
+        self._lock = RLock()
+        self._timer = None
+
+    def sample(self):
+        """
+        Return the (streams, statistics) tuple of a new snapshot. The
+        statistics buffer is reused by the following snapshots as long as it
+        is large enough, so it should be copied if it needs to be kept.
+        """
+        from sipsimple.application import SIPApplication
+        field_count = len(RTP_STATISTICS_FIELDS)
+        with self._lock:
+            transports = []
+            for mixer in [SIPApplication.voice_audio_mixer] + SIPApplication.get_headless_audio_mixers():
+                if mixer is None:
+                    continue
+                while True:
+                    try:
+                        mixer_transports, buffer = mixer.get_rtp_statistics(self._buffer, len(transports))
+                    except ValueError:
+                        # Allocate a new buffer, so the ones already handed out stay valid
+                        buffer = array('I', [0]) * max(2*len(self._buffer), 64*field_count)
+                        buffer[:len(self._buffer)] = self._buffer
+                        self._buffer = buffer
+                    else:
+                        transports.extend(mixer_transports)
+                        break
+            streams = []
+            for transport in transports:
+                stream_ref = AudioStream._transport_streams.get(transport)
+                streams.append(stream_ref() if stream_ref is not None else None)
+            return streams, self._buffer
+
+    @run_in_twisted_thread
+    def start(self, interval=5):
+        with self._lock:
+            self.interval = interval
+            if self._timer is not None and self._timer.active():
+                self._timer.cancel()
+            self._timer = reactor.callLater(self.interval, self._run)
+
+    @run_in_twisted_thread
+    def stop(self):
+        with self._lock:
+            self.interval = None
+            if self._timer is not None and self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+    def _run(self):
+        streams, statistics = self.sample()
+        notification_center = NotificationCenter()
+        notification_center.post_notification('RTPStatisticsSamplerDidSample', sender=self, data=TimestampedNotificationData(streams=streams, statistics=statistics, fields=RTP_STATISTICS_FIELDS))
+        with self._lock:
+            if self.interval is not None:
+                self._timer = reactor.callLater(self.interval, self._run)
@@ -142,10 +142,11 @@ class MultilingualText(unicode):
 
 
 class Route(object):
-    def __init__(self, address, port=None, transport='udp'):
+    def __init__(self, address, port=None, transport='udp', expiration=None):
         self.address = address
         self.port = port
         self.transport = transport
+        self.expiration = expiration
 
     def _get_address(self):
         return self._address
@@ -32,7 +32,7 @@ from zope.interface import implements
 from sipsimple.account import ContactURI
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import ContactHeader, FromHeader, PJSIPError, RouteHeader, ToHeader, SIPCoreError, SIPURI, Subscription
-from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.lookup import DNSLookup, DNSLookupError, RouteHealthCache
 from sipsimple.payloads import ParserError
 from sipsimple.payloads import dialogrules, extensions, omapolicy, policy as common_policy, prescontent, presdm, presrules, resourcelists, rlsservices, rpid, xcapcaps, xcapdiff
 from sipsimple.util import All, Any, Command, TimestampedNotificationData, limit, makedirs, run_in_green_thread, run_in_twisted_thread
@@ -1002,6 +1002,10 @@ class XCAPManager(object):
                 timeout = random.uniform(15, 30)
                 raise SubscriptionError(error='DNS lookup failed: %s' % e, timeout=timeout)
 
+            # Start with the routes which worked last
+            route_cache = RouteHealthCache()
+            routes = route_cache.sort_routes(uri.host, routes)
+
             rlist = resourcelists.List()
             for document in (doc for doc in self.documents if doc.supported):
                 rlist.append(resourcelists.Entry(document.relative_uri))
@@ -1030,6 +1034,7 @@ class XCAPManager(object):
                             if notification.sender is subscription and notification.name == 'SIPSubscriptionDidStart':
                                 break
                     except SIPCoreError:
+                        route_cache.failure(uri.host, route)
                         continue
                     except SIPSubscriptionDidFail, e:
                         notification_center.remove_observer(self, sender=subscription)
@@ -1049,8 +1054,11 @@ class XCAPManager(object):
                             raise SubscriptionError(error='Subscription error', timeout=timeout)
                         else:
                             # Otherwise just try the next route
+                            if route_cache.is_route_failure(e.code):
+                                route_cache.failure(uri.host, route)
                             continue
                     else:
+                        route_cache.success(uri.host, route)
                         self.subscription = subscription
                         command.signal()
                         break
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+"""
+Tests for the speaker selection of ActiveSpeakerAudioBridge. The mixer is
+replaced with one which, like the conference bridge of PJMEDIA, only measures
+the level of the slots which have at least one listener.
+
+Usage: active_speaker_bridge.py
+"""
+
+import unittest
+import weakref
+
+from zope.interface import implements
+
+from sipsimple import audio
+from sipsimple.audio import ActiveSpeakerAudioBridge, IAudioPort
+
+
+class Mixer(object):
+    def __init__(self):
+        self.connections = set()
+        self.levels = {}
+        self.slots = 0
+
+    def connect_slots(self, source, destination):
+        self.connections.add((source, destination))
+
+    def disconnect_slots(self, source, destination):
+        self.connections.discard((source, destination))
+
+    def get_signal_level(self, slot):
+        listened = any(source == slot for source, destination in self.connections)
+        return (0, self.levels.get(slot, 0) if listened else 0)
+
+
+class MixerPort(object):
+    def __init__(self, mixer):
+        self.mixer = mixer
+        self.slot = None
+
+    def start(self):
+        self.slot = self.mixer.slots
+        self.mixer.slots += 1
+
+    def stop(self):
+        self.slot = None
+
+
+class Port(object):
+    implements(IAudioPort)
+
+    def __init__(self, mixer):
+        self.mixer = mixer
+        self.consumer_slot = self.producer_slot = mixer.slots
+        mixer.slots += 1
+
+
+class ActiveSpeakerAudioBridgeTests(unittest.TestCase):
+    def setUp(self):
+        self.mixer_port_class = audio.MixerPort
+        audio.MixerPort = MixerPort
+        self.mixer = Mixer()
+        self.bridge = ActiveSpeakerAudioBridge(self.mixer, max_speakers=3)
+        self.ports = [Port(self.mixer) for i in xrange(4)]
+        for port in self.ports:
+            self.bridge.add(port)
+
+    def tearDown(self):
+        audio.MixerPort = self.mixer_port_class
+
+    def sample(self, count=5):
+        for i in xrange(count):
+            ActiveSpeakerAudioBridge._sample_levels(weakref.ref(self.bridge))
+
+    def speakers(self):
+        return set(wr() for wr in self.bridge.speakers)
+
+    def test_initial_speakers(self):
+        self.assertEqual(self.speakers(), set(self.ports[:3]))
+
+    def test_new_speaker_replaces_silent_one(self):
+        talker = self.ports[3]
+        self.mixer.levels[talker.producer_slot] = 100
+        self.mixer.levels[self.ports[0].producer_slot] = 50
+        self.mixer.levels[self.ports[1].producer_slot] = 50
+        self.sample()
+        self.assertEqual(self.speakers(), set([talker, self.ports[0], self.ports[1]]))
+        for port in self.ports[:3]:
+            self.failUnless((talker.producer_slot, port.consumer_slot) in self.mixer.connections)
+            self.failIf((self.ports[2].producer_slot, port.consumer_slot) in self.mixer.connections)
+
+    def test_removed_port_is_not_metered(self):
+        port = self.ports[3]
+        self.bridge.remove(port)
+        self.failIf((port.producer_slot, self.bridge.meter.slot) in self.mixer.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+"""
+Benchmark for the CPIM message codec. Compares the time it takes to generate
+and parse typical chat messages using the fast path of CPIMMessage with the
+time it takes using the email package, which is the fallback for the messages
+the fast path does not handle, and checks that both give the same results.
+
+Usage: cpim_benchmark.py [iterations]
+"""
+
+from __future__ import with_statement
+
+import sys
+from datetime import datetime
+from timeit import Timer
+
+from sipsimple.core import SIPURI
+from sipsimple.streams.applications.chat import ChatIdentity, CPIMMessage
+
+
+class EmailCodec(object):
+    """Make CPIMMessage use the email package for the MIME part of the messages"""
+
+    def __enter__(self):
+        self.encode_mime = CPIMMessage.__dict__['_encode_mime']
+        self.decode_mime = CPIMMessage.__dict__['_decode_mime']
+        CPIMMessage._encode_mime = CPIMMessage.__dict__['_encode_mime_message']
+        CPIMMessage._decode_mime = CPIMMessage.__dict__['_decode_mime_message']
+
+    def __exit__(self, type, value, traceback):
+        CPIMMessage._encode_mime = self.encode_mime
+        CPIMMessage._decode_mime = self.decode_mime
+
+
+def create_message():
+    sender = ChatIdentity(SIPURI.parse('sip:alice@example.com'), u'Alice')
+    recipient = ChatIdentity(SIPURI.parse('sip:bob@example.com'), u'Bob')
+    return CPIMMessage(u'Hello Bob, are you going to the meeting tomorrow?', 'text/plain', sender=sender, recipients=[recipient], timestamp=datetime.now())
+
+def parse_message(data):
+    CPIMMessage.parse(data)
+
+def parse_message_fully(data):
+    message = CPIMMessage.parse(data)
+    message.sender, message.recipients, message.timestamp
+
+def summary(message):
+    return (unicode(message.sender), [unicode(recipient) for recipient in message.recipients], message.timestamp, message.content_type, message.body)
+
+def run(name, function, iterations):
+    fast_time = Timer(function).timeit(iterations)
+    with EmailCodec():
+        email_time = Timer(function).timeit(iterations)
+    print '%-30s %10.2f us %10.2f us %8.2fx' % (name, fast_time/iterations*1e6, email_time/iterations*1e6, email_time/fast_time)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    message = create_message()
+    data = str(message)
+    with EmailCodec():
+        email_data = str(message)
+        email_summary = summary(CPIMMessage.parse(data))
+    if data != email_data:
+        print 'The generated messages are different:\n%r\n%r' % (data, email_data)
+        sys.exit(1)
+    if summary(CPIMMessage.parse(data)) != email_summary:
+        print 'The parsed messages are different'
+        sys.exit(1)
+    print '%-30s %13s %13s %9s' % ('', 'fast', 'email', 'speedup')
+    run('generate', lambda: str(message), iterations)
+    run('parse', lambda: parse_message(data), iterations)
+    run('parse and access identities', lambda: parse_message_fully(data), iterations)
+